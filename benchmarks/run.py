@@ -0,0 +1,363 @@
+# benchmarks/run.py
+"""
+Throughput and peak memory of the hot paths, on synthetic inputs and
+local stand-ins for Azure and Mongo, compared against baseline.json.
+
+    python benchmarks/run.py                      # all stages
+    python benchmarks/run.py toc_entries by_topic # some of them
+    python benchmarks/run.py --save-baseline      # record this machine's numbers
+
+Mongo is mongomock unless BENCH_MONGO_URI points at a (scratch) mongod.
+Peak memory is what tracemalloc sees, i.e. Python allocations; memory
+held inside PyMuPDF or shapely is not counted. Stages more than
+--tolerance slower, or using that much more memory, than their baseline
+are flagged. Timings only compare on the machine that recorded the
+baseline, so the exit status reflects them only with --fail-on-regression.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import tracemalloc
+import statistics
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path[:0] = [os.path.join(ROOT, "server"), os.path.join(ROOT, "rasa_backend"), HERE]
+
+# app.py configures INFO logging on import; per-call log lines would be timed too
+logging.basicConfig(level=logging.WARNING)
+
+# Stand-ins must be in place before the server modules connect at import time
+BENCH_MONGO_URI = os.getenv("BENCH_MONGO_URI")
+if not BENCH_MONGO_URI:
+    import mongomock
+    import mongomock.gridfs
+    import pymongo
+    pymongo.MongoClient = mongomock.MongoClient
+    mongomock.gridfs.enable_gridfs_integration()
+os.environ.setdefault("MONGO_URI", BENCH_MONGO_URI or "mongodb://localhost:27017/")
+os.environ.setdefault("DB_NAME", "pdf_bot_bench")
+os.environ.setdefault("DOC_INTEL_ENDPOINT", "https://bench.invalid/")
+os.environ.setdefault("DOC_INTEL_KEY", "bench")
+os.environ.setdefault("AZURE_ENDPOINT", "https://bench.invalid")
+os.environ.setdefault("AZURE_DEPLOYMENT", "bench")
+os.environ.setdefault("AZURE_API_KEY", "bench")
+# the throttles are not what is measured here
+os.environ.setdefault("DOC_INTEL_RPS", "1000000")
+os.environ.setdefault("AZURE_OPENAI_RPS", "1000000")
+os.environ.setdefault("AZURE_OPENAI_BURST", "1000000")
+# sheet_auto_merge measures the windowed layout path
+os.environ.setdefault("LAYOUT_WINDOW_PAGES", "20")
+
+import synthetic  # noqa: E402
+
+BASELINE_PATH = os.path.join(HERE, "baseline.json")
+
+# Input sizes; part of the baseline, which is only compared at equal sizes
+DEFAULT_SIZES = {
+    "pdf_pages": 300,       # synthetic PDF length
+    "toc_entries": 200,     # sections listed in its printed ToC
+    "queries": 400,         # topic lookups per by_topic/topic_search run
+    "sheet_pages": 40,      # Form Recognizer pages merged per run
+    "excel_rows": 20000,    # analyzer rows sent to /getexcel
+    "charts": 10,           # chart images per run
+}
+
+
+class Stage:
+    """
+    One benchmark: `setup(sizes, tmp)` returns (fn, items); fn() does the
+    work once and `items` says how many `unit`s that was.
+    """
+
+    def __init__(self, name, unit, setup):
+        self.name = name
+        self.unit = unit
+        self.setup = setup
+
+
+STAGES = []
+
+
+def stage(name, unit):
+    def register(setup):
+        STAGES.append(Stage(name, unit, setup))
+        return setup
+    return register
+
+
+_pdfs = {}   # path -> ToC entries of the synthetic PDFs made so far
+
+
+def _pdf(sizes, tmp):
+    """The synthetic PDF (made once per run) and its (title, page) ToC entries."""
+    path = os.path.join(tmp, "bench.pdf")
+    if path not in _pdfs:
+        _pdfs[path] = synthetic.make_pdf(path, sizes["pdf_pages"], sizes["toc_entries"])
+    return path, _pdfs[path]
+
+
+def _queries(titles, count):
+    """Exact titles, section numbers, lower-cased words and typos, in equal parts."""
+    queries = []
+    for i in range(count):
+        title = titles[(i * 7919) % len(titles)]
+        number, _, words = title.partition(" ")
+        kind = i % 4
+        if kind == 0:
+            queries.append(title)
+        elif kind == 1:
+            queries.append(f"section {number}")
+        elif kind == 2:
+            queries.append(words.lower())
+        else:
+            queries.append(words[:3] + words[4:] if len(words) > 4 else words)
+    return queries
+
+
+@stage("toc_page_range", "pdfs")
+def setup_toc_page_range(sizes, tmp):
+    from extract_toc import find_toc_page_range
+    path, _ = _pdf(sizes, tmp)
+    return lambda: find_toc_page_range(path), 1
+
+
+@stage("toc_entries", "entries")
+def setup_toc_entries(sizes, tmp):
+    from extract_toc import find_toc_page_range, extract_toc_entries
+    path, _ = _pdf(sizes, tmp)
+    start, end = find_toc_page_range(path)
+    return lambda: extract_toc_entries(path, start, end), sizes["toc_entries"]
+
+
+@stage("extract_topic_map", "pdfs")
+def setup_extract_topic_map(sizes, tmp):
+    """The /upload ToC path, on a PDF without bookmarks (outline misses, PyMuPDF text finds it)."""
+    from extract_toc import extract_topic_map
+    path, _ = _pdf(sizes, tmp)
+    return lambda: extract_topic_map(path), 1
+
+
+@stage("topic_search", "queries")
+def setup_topic_search(sizes, tmp):
+    from actions.topic_index import TopicIndex, build_topic_index
+    titles = synthetic.toc_titles(sizes["toc_entries"])
+    index = TopicIndex(build_topic_index({t: [1, 1] for t in titles}))
+    queries = _queries(titles, sizes["queries"])
+
+    def run():
+        for q in queries:
+            index.search(q, k=5)
+    return run, len(queries)
+
+
+@stage("by_topic", "queries")
+def setup_by_topic(sizes, tmp):
+    """by_topic end to end: fuzzy match, then the page texts from the page store."""
+    from bson import ObjectId
+    from actions.actions import ActionSearchByTopicOrPage
+    from actions.topic_index import TopicIndex, build_topic_index
+    from extract_toc import build_topic_map
+    from page_store import extract_page_texts, store_pages
+
+    action = ActionSearchByTopicOrPage()
+    path, entries = _pdf(sizes, tmp)
+    texts = extract_page_texts(path)
+    mapping_id = ObjectId()
+    store_pages(action.store.pages, mapping_id, texts)
+    topic_map = build_topic_map(entries)
+    index = TopicIndex(build_topic_index(topic_map))
+    source = {"mapping_id": mapping_id, "page_count": len(texts)}
+    queries = _queries(list(topic_map), sizes["queries"])
+
+    def run():
+        for q in queries:
+            action.by_topic(q, topic_map, index, source)
+    return run, len(queries)
+
+
+@stage("sheet_merge", "pages")
+def setup_sheet_merge(sizes, tmp):
+    """page_layouts + sheet_data: reducing AnalyzeResults and merging tables/lines."""
+    import spreadsheet_analysis as sheets
+    result = synthetic.fake_analyze_result(sizes["sheet_pages"])
+    return lambda: sheets.sheet_data(sheets.page_layouts(result)), sizes["sheet_pages"]
+
+
+@stage("sheet_auto_merge", "pages")
+def setup_sheet_auto_merge(sizes, tmp):
+    """
+    analyze_spreadsheet_auto_merge with empty caches each run: page
+    fingerprints, layout windows, fake Azure, merge and cache writes.
+    """
+    import fitz
+    import spreadsheet_analysis as sheets
+    client = synthetic.FakeDocumentClient()
+    doc = fitz.open()
+    for n in range(sizes["sheet_pages"]):
+        doc.new_page().insert_text((72, 72), f"sheet page {n}")
+    pdf_bytes = doc.tobytes()
+    doc.close()
+    pages = sizes["sheet_pages"]
+    windows = -(-pages // (sheets.LAYOUT_WINDOW_PAGES or pages))
+
+    def run():
+        sheets.coll.delete_many({})
+        sheets.page_coll.delete_many({})
+        calls = client.calls
+        sheets.analyze_spreadsheet_auto_merge(pdf_bytes, "bench.pdf", client)
+        # one Azure call per layout window, every page cached: not the whole-document fallback
+        assert client.calls - calls == windows, (client.calls - calls, windows)
+        assert sheets.page_coll.count_documents({}) == pages
+    return run, pages
+
+
+def _flask_client():
+    import app
+    return app.app.test_client()
+
+
+@stage("getexcel_xlsx", "rows")
+def setup_getexcel_xlsx(sizes, tmp):
+    client = _flask_client()
+    body = json.dumps(synthetic.analyzer_sheet(sizes["excel_rows"]))
+
+    def run():
+        resp = client.post("/getexcel", data=body, content_type="application/json")
+        assert resp.status_code == 200, resp.status_code
+        resp.get_data()
+    return run, sizes["excel_rows"]
+
+
+@stage("getexcel_csv", "rows")
+def setup_getexcel_csv(sizes, tmp):
+    client = _flask_client()
+    body = json.dumps(synthetic.analyzer_sheet(sizes["excel_rows"]))
+
+    def run():
+        resp = client.post("/getexcel?format=csv", data=body, content_type="application/json")
+        assert resp.status_code == 200, resp.status_code
+        resp.get_data()
+    return run, sizes["excel_rows"]
+
+
+@stage("chart_upload", "images")
+def setup_chart_upload(sizes, tmp):
+    """analyze_chart_image against the recorded Azure OpenAI response, cache misses only."""
+    import graph_upload_server as charts
+    charts.http = synthetic.RecordedOpenAI()
+    images = synthetic.chart_images(sizes["charts"])
+
+    def run():
+        charts.chart_cache._mem.clear()
+        charts.cache_coll.delete_many({})
+        for image in images:
+            charts.chart_payload(*charts.analyze_chart_image(image))
+    return run, len(images)
+
+
+def measure(stage_, sizes, tmp, repeat):
+    fn, items = stage_.setup(sizes, tmp)
+    fn()  # warm-up: imports, caches, lazy connections
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    best = min(times)
+    return {"unit": stage_.unit, "items": items,
+            "median_s": round(statistics.median(times), 6), "best_s": round(best, 6),
+            "throughput": round(items / best, 3), "peak_kib": round(peak / 1024, 1)}
+
+
+def compare(results, baseline, tolerance):
+    """Lines describing each stage against its baseline, and whether any regressed."""
+    lines, regressed = [], False
+    for name, r in results.items():
+        base = baseline.get(name)
+        if not base:
+            lines.append(f"{name:<20} {r['throughput']:>12.1f} {r['unit']}/s "
+                         f"{r['peak_kib']:>10.0f} KiB   (no baseline)")
+            continue
+        speed = r["throughput"] / base["throughput"] - 1
+        memory = r["peak_kib"] / base["peak_kib"] - 1 if base["peak_kib"] else 0.0
+        flags = []
+        if speed < -tolerance:
+            flags.append("SLOWER")
+        if memory > tolerance:
+            flags.append("MORE MEMORY")
+        regressed |= bool(flags)
+        lines.append(f"{name:<20} {r['throughput']:>12.1f} {r['unit']}/s ({speed:+6.1%}) "
+                     f"{r['peak_kib']:>10.0f} KiB ({memory:+6.1%})  {' '.join(flags)}")
+    return lines, regressed
+
+
+def main(argv=None):
+    names = [s.name for s in STAGES]
+    parser = argparse.ArgumentParser(description="Benchmark the PDF bot's hot paths.")
+    parser.add_argument("stages", nargs="*", metavar="STAGE",
+                        help=f"stages to run (default all): {', '.join(names)}")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per stage (best counts)")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="relative slowdown or memory growth reported as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true",
+                        help="exit 1 when a stage regressed (use with a baseline from this machine)")
+    parser.add_argument("--save-baseline", action="store_true", help="write the results to baseline.json")
+    parser.add_argument("--json", metavar="PATH", help="also write the results to PATH")
+    for key, value in DEFAULT_SIZES.items():
+        parser.add_argument(f"--{key.replace('_', '-')}", type=int, default=value, dest=key)
+    args = parser.parse_args(argv)
+    unknown = set(args.stages) - set(names)
+    if unknown:
+        parser.error(f"unknown stage(s): {', '.join(sorted(unknown))}")
+    sizes = {key: getattr(args, key) for key in DEFAULT_SIZES}
+    selected = [s for s in STAGES if not args.stages or s.name in args.stages]
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="pdfbot-bench-") as tmp:
+        for s in selected:
+            results[s.name] = measure(s, sizes, tmp, args.repeat)
+            r = results[s.name]
+            print(f"  {s.name}: {r['throughput']:.1f} {r['unit']}/s, peak {r['peak_kib']:.0f} KiB",
+                  file=sys.stderr)
+
+    report = {"sizes": sizes, "python": sys.version.split()[0], "stages": results}
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    baseline = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH, encoding="utf-8") as f:
+            stored = json.load(f)
+        if stored.get("sizes") == sizes:
+            baseline = stored["stages"]
+        else:
+            print("baseline.json was recorded with other sizes; not comparing", file=sys.stderr)
+
+    lines, regressed = compare(results, baseline, args.tolerance)
+    print("\n".join(lines))
+
+    if args.save_baseline:
+        if baseline and len(results) < len(STAGES):
+            report["stages"] = {**baseline, **results}
+        with open(BASELINE_PATH, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+        print(f"Saved {BASELINE_PATH}", file=sys.stderr)
+        return 0
+    return 1 if regressed and args.fail_on_regression else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,193 @@
+# benchmarks/synthetic.py
+"""
+Deterministic inputs for the benchmarks: PDFs with a printed ToC,
+Form Recognizer AnalyzeResult look-alikes, analyzer sheets for
+/getexcel, chart images, and a recorded Azure OpenAI response.
+"""
+import io
+import json
+import os
+import random
+from types import SimpleNamespace
+
+import fitz  # PyMuPDF
+from PyPDF2 import PdfReader
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+WORDS = ("robot joint kinematics frame matrix rotation velocity sensor actuator control "
+         "trajectory planning dynamics torque link manipulator inverse direct model "
+         "filter wheel loading scheduler command interface calibration").split()
+
+
+def toc_titles(count, seed=0):
+    """`count` numbered section titles ("2.3.1 Joint Velocity Sensor"), nested up to three levels."""
+    rng = random.Random(seed)
+    titles, number = [], [0]
+    for _ in range(count):
+        move = rng.random()
+        if move < 0.3 and len(number) < 3:
+            number.append(1)
+        elif move < 0.5 and len(number) > 1:
+            number.pop()
+            number[-1] += 1
+        else:
+            number[-1] += 1
+        words = " ".join(rng.choice(WORDS).capitalize() for _ in range(rng.randint(2, 5)))
+        titles.append(f"{'.'.join(map(str, number))} {words}")
+    return titles
+
+
+def make_pdf(path, pages, toc_entries, seed=0, outline=False):
+    """
+    A PDF of `pages` pages: a title page, printed "Contents" pages listing
+    `toc_entries` sections with dot leaders, then body text. With
+    `outline` the sections are also added as bookmarks. Returns the
+    (title, page) ToC entries.
+    """
+    rng = random.Random(seed)
+    per_toc_page = 40
+    toc_pages = max(2, -(-toc_entries // per_toc_page))
+    body_start = 2 + toc_pages
+    body_pages = max(1, pages - body_start + 1)
+    titles = toc_titles(toc_entries, seed)
+    starts = sorted(rng.randint(body_start, body_start + body_pages - 1) for _ in titles)
+    entries = list(zip(titles, starts))
+
+    doc = fitz.open()
+    doc.new_page().insert_text((72, 100), "Synthetic benchmark document", fontsize=20)
+    for t in range(toc_pages):
+        page = doc.new_page()
+        y = 60
+        if t == 0:
+            page.insert_text((72, y), "Contents", fontsize=14)
+            y += 24
+        for title, start in entries[t * per_toc_page:(t + 1) * per_toc_page]:
+            page.insert_text((72, y), f"{title} {'.' * 12} {start}", fontsize=9)
+            y += 17
+    for n in range(body_start, body_start + body_pages):
+        page = doc.new_page()
+        text = "\n".join(" ".join(rng.choice(WORDS) for _ in range(12)) for _ in range(40))
+        page.insert_textbox(fitz.Rect(72, 72, 540, 760), f"Page {n}\n{text}", fontsize=9)
+    if outline:
+        doc.set_toc([[t.split()[0].count(".") + 1, t, s] for t, s in entries])
+    doc.save(path)
+    doc.close()
+    return entries
+
+
+# --- Form Recognizer ---
+
+def _polygon(x0, y0, x1, y1):
+    return [SimpleNamespace(x=x, y=y) for x, y in ((x0, y0), (x1, y0), (x1, y1), (x0, y1))]
+
+
+def fake_analyze_result(pages, tables_per_page=3, rows=20, cols=6, lines_per_page=30, seed=0):
+    """
+    An object shaped like azure.ai.formrecognizer.AnalyzeResult, as far as
+    spreadsheet_analysis.page_layouts reads it. Each page has a band of
+    side-by-side tables, a table below them, and text lines around them.
+    """
+    rng = random.Random(seed)
+    result_pages, tables = [], []
+    for n in range(1, pages + 1):
+        lines = []
+        for i in range(lines_per_page):
+            y = 0.2 + i * (10.5 / lines_per_page)
+            lines.append(SimpleNamespace(polygon=_polygon(0.5, y, 4.0, y + 0.15),
+                                         content=" ".join(rng.choice(WORDS) for _ in range(6))))
+        result_pages.append(SimpleNamespace(page_number=n, lines=lines))
+        for t in range(tables_per_page):
+            band = t // 2                      # two tables side by side per band
+            x0 = 0.5 + (t % 2) * 4.0
+            y0 = 1.0 + band * 4.5
+            cells = [SimpleNamespace(row_index=r, column_index=c, column_span=1,
+                                     content=f"{rng.randint(0, 99999)}")
+                     for r in range(rows) for c in range(cols)]
+            tables.append(SimpleNamespace(
+                bounding_regions=[SimpleNamespace(page_number=n,
+                                                  polygon=_polygon(x0, y0, x0 + 3.8, y0 + 4.0))],
+                cells=cells))
+    return SimpleNamespace(pages=result_pages, tables=tables)
+
+
+class FakeDocumentClient:
+    """
+    Stands in for DocumentAnalysisClient: begin_analyze_document answers
+    at once with a fake_analyze_result for the pages of the document sent.
+    """
+
+    def __init__(self, **layout):
+        self.layout = layout
+        self.calls = 0
+
+    def begin_analyze_document(self, model, document, **kwargs):
+        self.calls += 1
+        pages = len(PdfReader(document).pages)
+        result = fake_analyze_result(pages, seed=self.calls, **self.layout)
+        return SimpleNamespace(result=lambda: result)
+
+
+# --- /getexcel ---
+
+def analyzer_sheet(rows, cols=8, seed=0):
+    """Analyzer output (the /upload_sheet `data`) with one sheet of rows x cols."""
+    rng = random.Random(seed)
+    return {"activeSheet": "Sheet1", "sheets": [{"name": "Sheet1", "rows": [
+        {"index": r + 1,
+         "cells": [{"value": rng.choice(WORDS) if c % 2 else rng.randint(0, 10 ** 6),
+                    "enable": True, "index": c + 1} for c in range(cols)]}
+        for r in range(rows)]}]}
+
+
+# --- charts ---
+
+def chart_images(count, width=2400, height=1600, seed=0):
+    """`count` distinct PNG bar charts (distinct bytes, so no cache hits)."""
+    from PIL import Image, ImageDraw
+    rng = random.Random(seed)
+    images = []
+    for i in range(count):
+        img = Image.new("RGB", (width, height), "white")
+        draw = ImageDraw.Draw(img)
+        bars = 12
+        for b in range(bars):
+            h = rng.randint(height // 10, height - 100)
+            x = 50 + b * (width - 100) // bars
+            draw.rectangle([x, height - 50 - h, x + (width - 100) // bars - 20, height - 50],
+                           fill=(rng.randint(0, 255), rng.randint(0, 255), 200))
+        draw.text((20, 20), f"chart {i}", fill="black")
+        out = io.BytesIO()
+        img.save(out, "PNG")
+        images.append(out.getvalue())
+    return images
+
+
+class RecordedResponse:
+    def __init__(self, body, status_code=200):
+        self._body = body
+        self.status_code = status_code
+
+    def json(self):
+        return json.loads(self._body)
+
+    def raise_for_status(self):
+        pass
+
+
+class RecordedOpenAI:
+    """
+    Replaces graph_upload_server.http: every chat completion is answered
+    with the response recorded in fixtures/chart_completion.json.
+    """
+
+    def __init__(self, path=os.path.join(FIXTURES, "chart_completion.json")):
+        with open(path, encoding="utf-8") as f:
+            self.body = f.read()
+        self.calls = 0
+        self.sent_bytes = 0
+
+    def post(self, url, json=None, **kwargs):
+        self.calls += 1
+        self.sent_bytes += len(json["messages"][0]["content"][1]["image_url"]["url"])
+        return RecordedResponse(self.body)
@@ -1,26 +1,50 @@
 # actions.py
 import os
-import re
-import difflib
-import tempfile
 from typing import List, Tuple
 
 import pymongo
 import gridfs
-import fitz  # PyMuPDF
+import requests
 from rasa_sdk import Action, Tracker
 from rasa_sdk.executor import CollectingDispatcher
 from rasa_sdk.events import SlotSet
 from rasa_sdk.types import DomainDict
 
+from .pdf_cache import PdfDocumentCache
+from .page_ranges import merge_page_ranges
+from .topic_index import TopicIndex, TopicIndexCache, SectionIndex
+from .library_index import LibraryIndex, DocumentRecords
+
 # --- CONFIG must match your Flask server ---
 MONGO_URI    = "mongodb://localhost:27017/"
 DB_NAME      = "pdf_bot"
 PDF_BUCKET   = "pdfs"
 INDEX_COLL   = "index"
 MAPPING_COLL = "mappings"
+PAGE_COLL    = "pages"
+META_COLL    = "meta"
+CHANGE_COLL  = "library_changes"
+SERVER_URL   = os.getenv("PDF_SERVER_URL", "http://localhost:5001")
 # ----------------
 
+# Opened PDFs kept for follow-up questions (legacy uploads without a page store)
+PDF_CACHE_MAX_BYTES = int(os.getenv("PDF_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+PDF_CACHE_MAX_IDLE  = float(os.getenv("PDF_CACHE_MAX_IDLE", 30 * 60))
+
+MAX_OUTPUT_CHARS       = int(os.getenv("MAX_OUTPUT_CHARS", 20000))  # text per reply
+TOPIC_INDEX_CACHE_SIZE = 64    # mappings whose topic index stays in memory
+TOPIC_SUGGESTIONS      = 5     # matches offered when a topic is ambiguous
+TOPIC_AMBIGUITY        = 0.02  # fuzzy scores this close count as a tie
+SECTION_LABELS         = 3     # section titles named in a page-range header
+
+# Topic search across all documents (no PDF chosen yet)
+MASTER_INDEX_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                 "master_index.json")
+LIBRARY_REFRESH_SECONDS = float(os.getenv("LIBRARY_REFRESH_SECONDS", 5))
+LIBRARY_HITS            = 8     # documents/topics listed for a library-wide search
+LIBRARY_CHANGE_STREAM   = os.getenv("LIBRARY_CHANGE_STREAM", "0") == "1"  # needs a replica set
+RECORD_CACHE_SIZE       = int(os.getenv("RECORD_CACHE_SIZE", 1024))  # filenames kept in memory
+
 
 def parse_page_query(page_query: str) -> List[Tuple[int, int]]:
     """
@@ -40,9 +64,13 @@ def parse_page_query(page_query: str) -> List[Tuple[int, int]]:
     return segments
 
 
-class ActionSearchByTopicOrPage(Action):
-    def name(self) -> str:
-        return "action_search_by_topic_or_page"
+class DocumentStore:
+    """
+    Mongo handles and the in-memory caches behind the PDF actions. rasa_sdk
+    instantiates every Action class, so the actions share the one instance
+    document_store() returns instead of each opening its own client,
+    caches and library watcher.
+    """
 
     def __init__(self):
         client      = pymongo.MongoClient(MONGO_URI)
@@ -50,51 +78,181 @@ class ActionSearchByTopicOrPage(Action):
         self.fs     = gridfs.GridFS(self.db, collection=PDF_BUCKET)
         self.idx    = self.db[INDEX_COLL]
         self.maps   = self.db[MAPPING_COLL]
+        self.pages  = self.db[PAGE_COLL]
+        self.pdf_cache = PdfDocumentCache(PDF_CACHE_MAX_BYTES, PDF_CACHE_MAX_IDLE)
+        self.topic_indexes = TopicIndexCache(TOPIC_INDEX_CACHE_SIZE)
+        self.section_indexes = TopicIndexCache(TOPIC_INDEX_CACHE_SIZE, SectionIndex.for_mapping)
+        self.library = LibraryIndex(self.idx, self.maps, self.db[META_COLL], self.db[CHANGE_COLL],
+                                    MASTER_INDEX_PATH, LIBRARY_REFRESH_SECONDS)
+        if LIBRARY_CHANGE_STREAM:
+            self.library.watch()
+        self.records = DocumentRecords(self.library, self.load_record, RECORD_CACHE_SIZE)
+
+    def load_record(self, pdf_name: str):
+        """
+        (idx_doc, map_doc) for a filename, either None when unknown. The
+        stored indexes are handed to the index caches and dropped from the
+        mapping, so `records` holds only what the reply needs.
+        """
+        idx_doc = self.idx.find_one({"filename": pdf_name})
+        map_doc = self.load_mapping(idx_doc.get("mapping_id")) if idx_doc else None
+        if map_doc:
+            self.topic_indexes.get(map_doc["_id"], map_doc)
+            self.section_indexes.get(map_doc["_id"], map_doc)
+            map_doc.pop("topic_index", None)
+            map_doc.pop("section_index", None)
+        return idx_doc, map_doc
+
+    def load_mapping(self, mapping_id):
+        """The mapping document, without the indexes already cached for it."""
+        projection = {field: 0 for field, cache in (("topic_index", self.topic_indexes),
+                                                     ("section_index", self.section_indexes))
+                      if mapping_id in cache}
+        return self.maps.find_one({"_id": mapping_id}, projection or None)
+
+
+_store = None
+
 
-    def clean_topic_key(self, key: str) -> str:
-        return re.sub(r"^\d+(\.\d+)*\s*", "", key).strip().lower()
+def document_store() -> DocumentStore:
+    """The process-wide DocumentStore, created on first use."""
+    global _store
+    if _store is None:
+        _store = DocumentStore()
+    return _store
 
-    def extract_pdf_text(self, path: str, start: int, end: int) -> str:
-        doc = fitz.open(path)
-        pages = []
-        for p in range(start - 1, end):
-            pages.append(doc.load_page(p).get_text())
-        doc.close()
-        return "\n".join(pages).strip()
 
-    def get_by_pages(self, start: int, end: int, pdf_path: str) -> str:
+class ActionSearchByTopicOrPage(Action):
+    def name(self) -> str:
+        return "action_search_by_topic_or_page"
+
+    def __init__(self):
+        self.store = document_store()
+
+    def page_source(self, pdf_name: str, idx_doc: dict, map_doc: dict) -> dict:
+        """
+        PDFs uploaded with a per-page text store are read from it directly;
+        older uploads fall back to the raw PDF in GridFS, kept open in
+        `pdf_cache` between messages.
+        """
+        if map_doc and map_doc.get("page_count"):
+            return {"mapping_id": map_doc["_id"], "page_count": map_doc["page_count"]}
+        if idx_doc and idx_doc.get("file_id") is not None:
+            gf = self.store.fs.find_one({"_id": idx_doc["file_id"]})
+        else:
+            gf = self.store.fs.find_one({"filename": pdf_name})
+        if gf is None:
+            raise LookupError(f"'{pdf_name}' is not in the PDF store")
+        return {"doc": self.store.pdf_cache.get(pdf_name, gf)}
+
+    def page_count(self, source: dict) -> int:
+        return source["page_count"] if "mapping_id" in source else source["doc"].page_count
+
+    def iter_page_texts(self, source: dict, ranges: List[Tuple[int, int]]):
+        """(page, text) for every page of the sorted, disjoint ranges, in order."""
+        if "mapping_id" in source:
+            cursor = self.store.pages.find(
+                {"mapping_id": source["mapping_id"],
+                 "$or": [{"page": {"$gte": s, "$lte": e}} for s, e in ranges]},
+                {"_id": 0, "page": 1, "text": 1}
+            ).sort("page", 1)
+            try:
+                for d in cursor:
+                    yield d["page"], d["text"]
+            finally:
+                cursor.close()
+        else:
+            doc = source["doc"]
+            for s, e in ranges:
+                for p in range(s, e + 1):
+                    yield p, doc.load_page(p - 1).get_text()
+
+    def range_bodies(self, page_ranges: List[Tuple[int, int]], source: dict):
+        """
+        Yield (start, end, body, read) for the merged ranges, `read` False
+        when body is an error instead of page text. All pages come from
+        one pass over the document, which stops once MAX_OUTPUT_CHARS of
+        text has been collected; the range cut short says so.
+        """
+        ranges = merge_page_ranges(page_ranges)
         try:
-            text = self.extract_pdf_text(pdf_path, start, end)
-            return text or "— no text on those pages —"
+            count = self.page_count(source)
         except Exception as ex:
-            return f"Error reading PDF: {ex}"
+            for s, e in ranges:
+                yield s, e, f"Error reading PDF: {ex}", False
+            return
+
+        valid = [(s, e) for s, e in ranges if s >= 1 and e <= count]
+        texts = self.iter_page_texts(source, valid)
+        budget = MAX_OUTPUT_CHARS
+        try:
+            for s, e in ranges:
+                if (s, e) not in valid:
+                    yield s, e, f"Error reading PDF: pages {s}-{e} out of range (1-{count})", False
+                    continue
+                chunk = []
+                try:
+                    for _ in range(s, e + 1):
+                        _, text = next(texts)
+                        chunk.append(text[:budget])
+                        budget -= len(chunk[-1])
+                        if budget <= 0:
+                            break
+                except Exception as ex:
+                    yield s, e, f"Error reading PDF: {ex}", False
+                    return
+                body = "\n".join(chunk).strip() or "— no text on those pages —"
+                if budget <= 0:
+                    yield s, e, (f"{body}\n\n✂️ Output stopped at {MAX_OUTPUT_CHARS} characters; "
+                                 "ask for fewer pages to see the rest."), True
+                    return
+                yield s, e, body, True
+        finally:
+            texts.close()
 
-    def by_page_ranges(self, page_ranges: List[Tuple[int, int]], pdf_path: str) -> str:
+    def get_by_pages(self, start: int, end: int, source: dict) -> str:
+        return next(self.range_bodies([(start, end)], source))[2]
+
+    def by_page_ranges(self, page_ranges: List[Tuple[int, int]], source: dict,
+                       sections: SectionIndex = None) -> str:
         parts = []
-        for s, e in page_ranges:
+        for s, e, body, read in self.range_bodies(page_ranges, source):
             header = f"📄 Page {s}" + (f"–{e}" if e != s else "")
-            body   = self.get_by_pages(s, e, pdf_path)
+            if sections and read:
+                header += section_label(sections, s, e)
             parts.append(f"{header}:\n\n{body}")
         return "\n\n".join(parts)
 
-    def by_topic(self, topic: str, topic_map: dict, pdf_path: str) -> str:
-        cleaned = {self.clean_topic_key(k): k for k in topic_map}
-        tl      = topic.lower().strip()
+    def by_topic(self, topic: str, topic_map: dict, topic_index: TopicIndex, source: dict) -> str:
+        matches = topic_index.search(topic, k=TOPIC_SUGGESTIONS)
+        if not matches:
+            return f"❌ Topic '{topic}' not found."
 
-        if tl in cleaned:
-            real = cleaned[tl]
-        else:
-            matches = difflib.get_close_matches(tl, cleaned.keys(), n=1, cutoff=0.6)
-            if not matches:
-                return f"❌ Topic '{topic}' not found."
-            real = cleaned[matches[0]]
+        real, score = matches[0]
+        if len(matches) > 1 and score - matches[1][1] < TOPIC_AMBIGUITY:
+            options = "\n".join(f"• {title}" for title, _ in matches)
+            return f"🤔 '{topic}' matches several topics. Which one do you mean?\n{options}"
 
         s, e = topic_map[real]
+        e = e or s  # the last ToC entry has no known end page
         header = (f"📘 '{real}' on page {s}" if s == e
                   else f"📘 '{real}' pages {s}–{e}")
-        body = self.get_by_pages(s, e, pdf_path)
+        body = self.get_by_pages(s, e, source)
         return f"{header}:\n\n{body}"
 
+    def by_library_topic(self, topic: str) -> str:
+        """Ranked topic hits across every known document."""
+        self.store.library.refresh()
+        hits = self.store.library.topics.search(topic, k=LIBRARY_HITS)
+        if not hits:
+            return f"❌ Topic '{topic}' not found in any PDF."
+        lines = [f"📚 '{topic}' in the library:"]
+        for (filename, title, _, s, e), _ in hits:
+            pages = f"page {s}" if not e or e == s else f"pages {s}–{e}"
+            lines.append(f"• {title} — {filename} ({pages})")
+        lines.append("Tell me which PDF to open to see the content.")
+        return "\n".join(lines)
+
     def run(self, dispatcher: CollectingDispatcher,
         tracker: Tracker, domain: DomainDict):
 
@@ -103,10 +261,14 @@ class ActionSearchByTopicOrPage(Action):
         page_query = tracker.get_slot("page_query")
 
         if not pdf_name:
+            if topic:
+                dispatcher.utter_message(self.by_library_topic(topic))
+                return [SlotSet("topic", None)]
             dispatcher.utter_message("❌ Please first tell me which PDF to load.")
             return []
 
-        idx_doc = self.idx.find_one({"filename": pdf_name})
+        # 2) Index entry and mapping, from memory unless re-uploaded since
+        idx_doc, map_doc = self.store.records.get(pdf_name)
         if not idx_doc:
             # If the user asked for a topic, this is a problem.
             if topic:
@@ -114,21 +276,13 @@ class ActionSearchByTopicOrPage(Action):
                 return []
             else:
                 # If it's a page-based query, we can still try to load the PDF from GridFS
-                idx_doc = {}  # create dummy
                 topic_map = {}
         else:
-            # 2) Fetch topic_map document
-            map_doc = self.maps.find_one({"_id": idx_doc.get("mapping_id")})
             topic_map = map_doc.get("topic_map", {}) if map_doc else {}
 
-        # 3) Load PDF into temp file
+        # 3) Resolve where page text is read from
         try:
-            gf       = self.fs.find_one({"filename": pdf_name})
-            pdf_data = gf.read()
-            tmp      = tempfile.NamedTemporaryFile(suffix=".pdf", delete=False)
-            tmp.write(pdf_data)
-            tmp.flush()
-            pdf_path = tmp.name
+            source = self.page_source(pdf_name, idx_doc, map_doc)
         except Exception as ex:
             dispatcher.utter_message(f"❌ Error loading PDF: {ex}")
             return []
@@ -145,7 +299,7 @@ class ActionSearchByTopicOrPage(Action):
             if page_query:
                 try:
                     ranges = parse_page_query(page_query)
-                    output = self.by_page_ranges(ranges, pdf_path)
+                    output = self.by_page_ranges(ranges, source)
                 except Exception:
                     output = "❌ Invalid page query. Use e.g. `5`, `5-7`, or `2,4,6-8`."
                 dispatcher.utter_message(output)
@@ -160,14 +314,120 @@ class ActionSearchByTopicOrPage(Action):
         if page_query:
             try:
                 ranges = parse_page_query(page_query)
-                output = self.by_page_ranges(ranges, pdf_path)
+                sections = self.store.section_indexes.get(map_doc["_id"], map_doc)
+                output = self.by_page_ranges(ranges, source, sections)
             except Exception:
                 output = "❌ Invalid page query. Use e.g. `5`, `5-7`, or `2,4,6-8`."
         elif topic:
-            output = self.by_topic(topic, topic_map, pdf_path)
+            topic_index = self.store.topic_indexes.get(map_doc["_id"], map_doc)
+            output = self.by_topic(topic, topic_map, topic_index, source)
         else:
             output = "❌ Please ask me for a topic or a page number/range."
 
         dispatcher.utter_message(output)
         return [SlotSet("topic", None), SlotSet("page_query", None)]
 
+
+def section_label(sections: SectionIndex, start: int, end: int) -> str:
+    """' — 2.3 Foo, 2.4 Bar' for the sections covering a page range, or ''."""
+    titles = [sections.titles[t] for t in sections.spanning(start, end)]
+    if not titles:
+        return ""
+    more = len(titles) - SECTION_LABELS
+    label = ", ".join(titles[:SECTION_LABELS]) + (f" (+{more} more)" if more > 0 else "")
+    return f" — {label}"
+
+
+class ActionFindSection(Action):
+    """Answers "what section is page N in" from the mapping's section index."""
+
+    def name(self) -> str:
+        return "action_find_section"
+
+    def __init__(self):
+        self.store = document_store()
+
+    def run(self, dispatcher: CollectingDispatcher,
+        tracker: Tracker, domain: DomainDict):
+
+        pdf_name   = tracker.get_slot("pdf_name")
+        page_query = tracker.get_slot("page_query")
+
+        if not pdf_name:
+            dispatcher.utter_message("❌ Please first tell me which PDF to load.")
+            return []
+        try:
+            page = parse_page_query(page_query)[0][0]
+        except Exception:
+            dispatcher.utter_message("❌ Which page? e.g. 'What section is page 57?'")
+            return [SlotSet("page_query", None)]
+
+        _, map_doc = self.store.records.get(pdf_name)
+        if not map_doc or not map_doc.get("topic_map"):
+            dispatcher.utter_message(
+                "ℹ️ No Table of Contents was found for this PDF, so I can't tell its sections."
+            )
+            return [SlotSet("page_query", None)]
+
+        page_count = map_doc.get("page_count")
+        if page < 1 or (page_count and page > page_count):
+            dispatcher.utter_message(f"❌ Page {page} is out of range (1-{page_count}).")
+            return [SlotSet("page_query", None)]
+
+        sections = self.store.section_indexes.get(map_doc["_id"], map_doc)
+        found = sections.at(page)
+        if not found:
+            dispatcher.utter_message(f"📑 Page {page} is not inside any section of the Table of Contents.")
+            return [SlotSet("page_query", None)]
+
+        path = sections.path(found[0])
+        output = f"📑 Page {page} is in '{path[-1]}'"
+        if len(path) > 1:
+            output += f" (part of {' › '.join(path[:-1])})"
+        others = [sections.titles[t] for t in found[1:] if sections.titles[t] not in path]
+        if others:
+            output += "\nAlso on that page: " + ", ".join(others)
+        dispatcher.utter_message(output + ".")
+        return [SlotSet("page_query", None)]
+
+
+class ActionSearchText(Action):
+    """Full-text search over the chosen PDF via the server's /search endpoint."""
+
+    def name(self) -> str:
+        return "action_search_text"
+
+    def __init__(self):
+        self.http = requests.Session()
+
+    def run(self, dispatcher: CollectingDispatcher,
+        tracker: Tracker, domain: DomainDict):
+
+        pdf_name = tracker.get_slot("pdf_name")
+        query    = tracker.get_slot("search_query")
+
+        if not pdf_name:
+            dispatcher.utter_message("❌ Please first tell me which PDF to load.")
+            return []
+        if not query:
+            dispatcher.utter_message("❌ What should I search for?")
+            return []
+
+        try:
+            resp = self.http.get(f"{SERVER_URL}/search",
+                                 params={"pdf": pdf_name, "q": query, "k": 5}, timeout=10)
+            body = resp.json()
+        except Exception as ex:
+            dispatcher.utter_message(f"❌ Search failed: {ex}")
+            return [SlotSet("search_query", None)]
+
+        if not body.get("ok"):
+            dispatcher.utter_message(f"❌ {body.get('error', 'Search failed')}")
+        elif not body["results"]:
+            dispatcher.utter_message(f"🔎 No pages mention '{query}'.")
+        else:
+            lines = [f"🔎 Best matches for '{query}':"]
+            for hit in body["results"]:
+                lines.append(f"📄 Page {hit['page']}: {hit['snippet']}")
+            dispatcher.utter_message("\n\n".join(lines))
+        return [SlotSet("search_query", None)]
@@ -0,0 +1,258 @@
+# library_index.py
+import os
+import json
+import time
+import logging
+import threading
+from collections import Counter, OrderedDict
+from difflib import SequenceMatcher
+from typing import Iterable, List, Tuple
+
+from .topic_index import MAX_CANDIDATES, normalize_topic, trigrams
+
+log = logging.getLogger(__name__)
+
+
+class GlobalTopicIndex:
+    """
+    ToC titles of every document in one exact-key and trigram index.
+    Documents are added and removed one at a time; removed entry ids are
+    reused, so the index never has to be rebuilt.
+    """
+
+    def __init__(self):
+        self.entries = []   # entry id -> (filename, title, key, start, end), None once removed
+        self.free    = []
+        self.by_file = {}   # filename -> entry ids
+        self.exact   = {}   # normalised title -> entry ids
+        self.grams   = {}   # trigram -> entry ids
+
+    def __len__(self) -> int:
+        return len(self.by_file)
+
+    def add_document(self, filename: str, topic_map: dict):
+        """Index `filename`'s topics, replacing whatever it had before."""
+        self.remove_document(filename)
+        ids = []
+        for title, (start, end) in topic_map.items():
+            key = normalize_topic(title)
+            entry = (filename, title, key, start, end)
+            if self.free:
+                i = self.free.pop()
+                self.entries[i] = entry
+            else:
+                i = len(self.entries)
+                self.entries.append(entry)
+            ids.append(i)
+            self.exact.setdefault(key, set()).add(i)
+            for g in trigrams(key):
+                self.grams.setdefault(g, set()).add(i)
+        self.by_file[filename] = ids
+
+    def remove_document(self, filename: str):
+        for i in self.by_file.pop(filename, ()):
+            key = self.entries[i][2]
+            self._discard(self.exact, key, i)
+            for g in trigrams(key):
+                self._discard(self.grams, g, i)
+            self.entries[i] = None
+            self.free.append(i)
+
+    @staticmethod
+    def _discard(postings: dict, key: str, i: int):
+        ids = postings.get(key)
+        if ids is not None:
+            ids.discard(i)
+            if not ids:
+                del postings[key]
+
+    def search(self, query: str, k: int = 5, cutoff: float = 0.6) -> List[Tuple[tuple, float]]:
+        """
+        Up to k (entry, score) pairs across all documents, best first;
+        entries are (filename, title, key, start, end) and exact hits score 1.0.
+        """
+        q = normalize_topic(query)
+        if not q:
+            return []
+        exact = self.exact.get(q, set())
+        hits = [(self.entries[i], 1.0) for i in sorted(exact)[:k]]
+
+        counts = Counter()
+        for g in trigrams(q):
+            counts.update(self.grams.get(g, ()))
+        scored = []
+        for i, _ in counts.most_common(MAX_CANDIDATES + len(exact)):
+            if i in exact:
+                continue
+            score = SequenceMatcher(None, q, self.entries[i][2]).ratio()
+            if score >= cutoff:
+                scored.append((score, i))
+        scored.sort(key=lambda s: (-s[0], s[1]))
+        return hits + [(self.entries[i], score) for score, i in scored[:k - len(hits)]]
+
+
+class LibraryIndex:
+    """
+    GlobalTopicIndex over the mappings listed in master_index.json and
+    every upload in the index collection. It follows the library version
+    the server bumps on /upload: at most one version check every
+    `refresh_every` seconds, after which only the filenames logged as
+    changed are re-read. A reader that fell behind the change log reloads.
+    With watch() a change stream on the log replaces the polling.
+    """
+
+    def __init__(self, idx, maps, meta, changes, master_index_path: str, refresh_every: float):
+        self.idx     = idx
+        self.maps    = maps
+        self.meta    = meta
+        self.changes = changes
+        self.master_index_path = master_index_path
+        self.refresh_every = refresh_every
+        self.topics  = GlobalTopicIndex()
+        self.version = None          # last library change applied
+        self._checked = -float("inf")
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._watching = False      # change stream open: sync only when it reports
+        self._dirty = True
+
+    def subscribe(self, listener):
+        """Call listener(filename) for each applied change, listener(None) on a reload."""
+        self._listeners.append(listener)
+
+    def _notify(self, filename):
+        for listener in self._listeners:
+            listener(filename)
+
+    def _due(self) -> bool:
+        if self._watching:
+            return self._dirty
+        return time.monotonic() - self._checked >= self.refresh_every
+
+    def refresh(self):
+        if not self._due():
+            return
+        with self._lock:
+            if not self._due():
+                return
+            self._dirty = False
+            try:
+                self._sync()
+            except Exception:
+                self._dirty = True
+                log.warning("Library index refresh failed; serving the previous one", exc_info=True)
+            self._checked = time.monotonic()
+
+    def watch(self):
+        """Follow the change log with a change stream (needs a replica set)."""
+        threading.Thread(target=self._watch, name="library-watch", daemon=True).start()
+        return self
+
+    def _watch(self):
+        try:
+            with self.changes.watch([{"$match": {"operationType": "insert"}}]) as stream:
+                self._watching, self._dirty = True, True
+                for _ in stream:
+                    self._dirty = True
+        except Exception:
+            log.warning("Library change stream unavailable; polling every %ss instead",
+                        self.refresh_every, exc_info=True)
+        finally:
+            self._watching, self._dirty = False, True
+
+    def _sync(self):
+        meta = self.meta.find_one({"_id": "library"})
+        version = meta["version"] if meta else 0
+        if self.version is None:
+            self._reload(version)
+            return
+        if version <= self.version:
+            return
+        for change in self.changes.find({"_id": {"$gt": self.version}}).sort("_id", 1):
+            if change["_id"] != self.version + 1:
+                # the change we need has expired (or is still being written)
+                self._reload(version)
+                return
+            doc = self.maps.find_one({"_id": change["mapping_id"]}, {"topic_map": 1})
+            self.topics.add_document(change["filename"], (doc or {}).get("topic_map", {}))
+            self.version = change["_id"]
+            self._notify(change["filename"])
+        if self.version < version:
+            # the log ended early: the last changes expired (or are still being written)
+            self._reload(version)
+
+    def _reload(self, version: int):
+        topics = GlobalTopicIndex()
+        for filename, topic_map in self._file_mappings():
+            topics.add_document(filename, topic_map)
+        for filename, topic_map in self._stored_mappings():
+            topics.add_document(filename, topic_map)
+        self.topics, self.version = topics, version
+        self._notify(None)
+        log.info("Library index loaded: %d documents at version %d", len(topics), version)
+
+    def _file_mappings(self) -> Iterable[Tuple[str, dict]]:
+        if not os.path.exists(self.master_index_path):
+            return
+        base = os.path.dirname(self.master_index_path)
+        with open(self.master_index_path, encoding="utf-8") as f:
+            master = json.load(f)
+        for filename, mapping_file in master.items():
+            try:
+                with open(os.path.join(base, "mappings", mapping_file), encoding="utf-8") as f:
+                    yield filename, json.load(f)
+            except (OSError, ValueError):
+                log.warning("Skipping unreadable mapping %s", mapping_file)
+
+    def _stored_mappings(self) -> Iterable[Tuple[str, dict]]:
+        mapping_ids = {d["filename"]: d.get("mapping_id")
+                       for d in self.idx.find({}, {"filename": 1, "mapping_id": 1})}
+        topic_maps = {d["_id"]: d.get("topic_map", {})
+                      for d in self.maps.find({"_id": {"$in": list(set(mapping_ids.values()))}},
+                                              {"topic_map": 1})}
+        for filename, mapping_id in mapping_ids.items():
+            yield filename, topic_maps.get(mapping_id, {})
+
+
+class DocumentRecords:
+    """
+    filename -> (idx_doc, map_doc) as `load(filename)` returns them, kept
+    in memory (LRU, `max_entries`) so a chat turn needs no Mongo reads.
+    Subscribed to a LibraryIndex: entries go when their filename is logged
+    as changed, and all at once when the library reloads. A load that
+    raced with such a change is returned but not kept.
+    """
+
+    def __init__(self, library: LibraryIndex, load, max_entries: int):
+        self.library = library
+        self.load = load
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._generation = 0        # bumped by every invalidation
+        self._lock = threading.Lock()
+        library.subscribe(self.invalidate)
+
+    def invalidate(self, filename=None):
+        with self._lock:
+            self._generation += 1
+            if filename is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(filename, None)
+
+    def get(self, filename: str) -> tuple:
+        self.library.refresh()
+        with self._lock:
+            record = self._entries.get(filename)
+            if record is not None:
+                self._entries.move_to_end(filename)
+                return record
+            generation = self._generation
+
+        record = self.load(filename)
+        with self._lock:
+            if generation == self._generation:
+                self._entries[filename] = record
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return record
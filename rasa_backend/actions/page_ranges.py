@@ -0,0 +1,17 @@
+# page_ranges.py
+# Also used by the server (server/extract_toc.py), so no Rasa imports here.
+from typing import List, Tuple
+
+
+def merge_page_ranges(ranges: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """
+    Sort, de-duplicate and merge overlapping or adjacent ranges:
+    [(6,8),(2,2),(3,4),(7,9)] -> [(2,4),(6,9)]
+    """
+    merged = []
+    for s, e in sorted((min(s, e), max(s, e)) for s, e in ranges):
+        if merged and s <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], e))
+        else:
+            merged.append((s, e))
+    return merged
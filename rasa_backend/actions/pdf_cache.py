@@ -0,0 +1,76 @@
+# pdf_cache.py
+import threading
+import time
+from collections import OrderedDict
+
+import fitz  # PyMuPDF
+
+
+class PdfDocumentCache:
+    """
+    Bounded LRU of opened PDFs, keyed by GridFS file id + md5 so a file
+    replaced by /upload under the same name is never served stale.
+    Entries are evicted once the cached PDF bytes exceed `max_bytes`
+    or after `max_idle` seconds without a hit.
+    """
+
+    def __init__(self, max_bytes: int, max_idle: float):
+        self.max_bytes = max_bytes
+        self.max_idle  = max_idle
+        self._entries  = OrderedDict()   # key -> {"doc", "size", "used"}
+        self._by_name  = {}              # filename -> key
+        self._total    = 0
+        self._lock     = threading.Lock()
+
+    @staticmethod
+    def key_for(grid_out) -> tuple:
+        # md5 is not computed by newer GridFS writers; the length still
+        # tells two files apart if an id were ever reused.
+        return (grid_out._id, getattr(grid_out, "md5", None) or grid_out.length)
+
+    def get(self, name: str, grid_out) -> fitz.Document:
+        key = self.key_for(grid_out)
+        now = time.monotonic()
+        with self._lock:
+            self._drop_idle(now)
+            old_key = self._by_name.get(name)
+            if old_key is not None and old_key != key:
+                # /upload replaced the file behind this name
+                self._drop(old_key)
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry["used"] = now
+                self._entries.move_to_end(key)
+                self._by_name[name] = key
+                return entry["doc"]
+
+        data = grid_out.read()
+        doc  = fitz.open(stream=data, filetype="pdf")
+        if len(data) > self.max_bytes:
+            return doc
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = {"doc": doc, "size": len(data), "used": now}
+                self._total += len(data)
+            self._by_name[name] = key
+            while self._total > self.max_bytes and len(self._entries) > 1:
+                self._drop(next(iter(self._entries)))
+            return self._entries[key]["doc"]
+
+    def _drop_idle(self, now: float):
+        # entries are kept in last-used order, so stale ones are at the front
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if now - entry["used"] <= self.max_idle:
+                break
+            self._drop(key)
+
+    def _drop(self, key):
+        # Documents are left to the garbage collector rather than closed here,
+        # so a caller still holding one is never handed a closed document.
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._total -= entry["size"]
+        for name in [n for n, k in self._by_name.items() if k == key]:
+            del self._by_name[name]
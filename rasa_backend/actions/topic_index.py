@@ -0,0 +1,237 @@
+# topic_index.py
+import re
+import math
+from bisect import bisect_right
+from collections import Counter, OrderedDict
+from difflib import SequenceMatcher
+from typing import List, Optional, Tuple
+
+# The builders below also run at upload time: server/topic_index.py
+# re-exports them, so the server and the action server share one copy.
+TOPIC_INDEX_VERSION = 1
+SECTION_INDEX_VERSION = 1
+
+SECTION_PAT = re.compile(r"^\s*(\d{1,3}(?:\.\d{1,3})*)\.?\s")
+QUERY_SECTION_PAT = re.compile(r"^\s*(\d{1,3}(?:\.\d{1,3})*)\.?\s*$")
+MAX_CANDIDATES = 50   # trigram candidates reranked per query
+
+
+def clean_topic_key(key: str) -> str:
+    return re.sub(r"^\d+(\.\d+)*\s*", "", key).strip().lower()
+
+
+def normalize_topic(text: str) -> str:
+    """Lower-case, numbering stripped, punctuation dropped, spaces collapsed."""
+    text = re.sub(r"[^\w\s]", " ", clean_topic_key(text))
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def trigrams(text: str) -> set:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def build_topic_index(topic_map: dict) -> dict:
+    """
+    Lookup structure for a topic_map, stored on the mapping document:
+    titles with their normalised keys and section numbers ("5.2") as
+    parallel lists, and a trigram -> title ids inverted index for fuzzy
+    candidates. Section numbers stay in a list because Mongo field names
+    cannot safely contain dots.
+    """
+    titles = list(topic_map)
+    keys = [normalize_topic(t) for t in titles]
+    sections = []
+    grams = {}
+    for i, (title, key) in enumerate(zip(titles, keys)):
+        m = SECTION_PAT.match(title)
+        sections.append(m.group(1) if m else None)
+        for g in trigrams(key):
+            grams.setdefault(g, []).append(i)
+    return {
+        "version": TOPIC_INDEX_VERSION,
+        "titles": titles,
+        "keys": keys,
+        "sections": sections,
+        "grams": grams,
+    }
+
+
+def section_depths(numbers: list) -> tuple:
+    """
+    Depth ("5.2.1" -> 3, unnumbered -> 0) and parent title id (-1 for none)
+    per title, the parent being the closest earlier title whose number is
+    a prefix of this one.
+    """
+    depth, parent = [], []
+    open_ids = {}   # section number -> latest title id carrying it
+    for i, num in enumerate(numbers):
+        if not num:
+            depth.append(0)
+            parent.append(-1)
+            continue
+        parts = num.split(".")
+        depth.append(len(parts))
+        up = -1
+        for k in range(len(parts) - 1, 0, -1):
+            up = open_ids.get(".".join(parts[:k]), -1)
+            if up >= 0:
+                break
+        parent.append(up)
+        open_ids[num] = i
+    return depth, parent
+
+
+def build_section_index(topic_map: dict) -> dict:
+    """
+    Compact page -> section structure, stored next to the topic index:
+    start pages ascending with the matching end pages (None when the
+    ToC gave no end) and title ids as parallel lists, plus depth and
+    parent per title id. Title ids are positions in the topic_map, the
+    same as in the topic index.
+    """
+    titles = list(topic_map)
+    numbers = []
+    for title in titles:
+        m = SECTION_PAT.match(title)
+        numbers.append(m.group(1) if m else None)
+    depth, parent = section_depths(numbers)
+    order = sorted(range(len(titles)), key=lambda i: (topic_map[titles[i]][0], i))
+    return {
+        "version": SECTION_INDEX_VERSION,
+        "starts": [topic_map[titles[i]][0] for i in order],
+        "ends": [topic_map[titles[i]][1] or None for i in order],
+        "ids": order,
+        "depth": depth,
+        "parent": parent,
+    }
+
+
+class TopicIndex:
+    """
+    Topic lookup for one mapping: exact normalised title, then a bare
+    section number ("5.2"), then trigram candidates reranked by difflib ratio.
+    """
+
+    def __init__(self, data: dict):
+        self.titles   = data["titles"]
+        self.keys     = data["keys"]
+        self.grams    = data["grams"]
+        # later titles win on duplicate keys, as the old dict lookup did
+        self.exact    = {k: i for i, k in enumerate(self.keys)}
+        self.sections = {s: i for i, s in enumerate(data["sections"]) if s}
+
+    @classmethod
+    def for_mapping(cls, map_doc: dict) -> "TopicIndex":
+        data = map_doc.get("topic_index")
+        if not data or data.get("version") != TOPIC_INDEX_VERSION:
+            data = build_topic_index(map_doc.get("topic_map", {}))
+        return cls(data)
+
+    def search(self, query: str, k: int = 5, cutoff: float = 0.6) -> List[Tuple[str, float]]:
+        """Up to k (title, score) pairs, best first; exact hits score 1.0."""
+        q = normalize_topic(query)
+        if q and q in self.exact:
+            return [(self.titles[self.exact[q]], 1.0)]
+        m = QUERY_SECTION_PAT.match(query)
+        if m and m.group(1) in self.sections:
+            return [(self.titles[self.sections[m.group(1)]], 1.0)]
+
+        counts = Counter()
+        for g in trigrams(q):
+            counts.update(self.grams.get(g, ()))
+        scored = []
+        for i, _ in counts.most_common(MAX_CANDIDATES):
+            score = SequenceMatcher(None, q, self.keys[i]).ratio()
+            if score >= cutoff:
+                scored.append((score, i))
+        scored.sort(key=lambda s: (-s[0], s[1]))
+        return [(self.titles[i], score) for score, i in scored[:k]]
+
+
+class SectionIndex:
+    """
+    Page -> section lookup over the sorted start/end arrays: bisect to the
+    last section starting at or before the page, then walk back only while
+    the running maximum of end pages can still reach it.
+    """
+
+    def __init__(self, data: dict, titles: List[str]):
+        self.titles = titles
+        self.starts = data["starts"]
+        self.ends   = [math.inf if e is None else e for e in data["ends"]]
+        self.ids    = data["ids"]
+        self.depth  = data["depth"]
+        self.parent = data["parent"]
+        self.max_end = []
+        reach = -math.inf
+        for e in self.ends:
+            reach = max(reach, e)
+            self.max_end.append(reach)
+
+    @classmethod
+    def for_mapping(cls, map_doc: dict) -> "SectionIndex":
+        topic_map = map_doc.get("topic_map", {})
+        data = map_doc.get("section_index")
+        if not data or data.get("version") != SECTION_INDEX_VERSION:
+            data = build_section_index(topic_map)
+        return cls(data, list(topic_map))
+
+    def _containing(self, page: int) -> List[int]:
+        """Positions in the sorted arrays of the sections containing `page`, ascending."""
+        found = []
+        i = bisect_right(self.starts, page) - 1
+        while i >= 0 and self.max_end[i] >= page:
+            if self.ends[i] >= page:
+                found.append(i)
+            i -= 1
+        return found[::-1]
+
+    def at(self, page: int) -> List[int]:
+        """Title ids of the sections containing `page`, deepest (then latest) first."""
+        ids = [self.ids[i] for i in self._containing(page)]
+        return sorted(ids, key=lambda t: (-self.depth[t], -t))
+
+    def spanning(self, start: int, end: int) -> List[int]:
+        """
+        Title ids labelling pages start..end: the innermost section at
+        `start`, then every section starting later within the range.
+        """
+        lo = bisect_right(self.starts, start)
+        hi = bisect_right(self.starts, end)
+        return self.at(start)[:1] + self.ids[lo:hi]
+
+    def path(self, title_id: int) -> List[str]:
+        """Titles from the outermost ancestor down to `title_id`."""
+        chain = []
+        while title_id >= 0:
+            chain.append(self.titles[title_id])
+            title_id = self.parent[title_id]
+        return chain[::-1]
+
+
+class TopicIndexCache:
+    """
+    Indexes per mapping_id, built by `build(map_doc)`; a mapping never
+    changes once written.
+    """
+
+    def __init__(self, max_entries: int, build=None):
+        self.max_entries = max_entries
+        self.build = build or TopicIndex.for_mapping
+        self._entries = OrderedDict()
+
+    def __contains__(self, mapping_id) -> bool:
+        return mapping_id in self._entries
+
+    def get(self, mapping_id, map_doc: Optional[dict] = None):
+        index = self._entries.get(mapping_id)
+        if index is None:
+            index = self.build(map_doc or {})
+            self._entries[mapping_id] = index
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(mapping_id)
+        return index
+
@@ -1,25 +1,52 @@
 # server/app.py
 import os
 import json
-import io
+import hashlib
+import zipfile
 import tempfile
 import logging
-from flask import Flask, request, jsonify, send_file
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import Flask, Response, request, jsonify, send_file
 from flask_cors import CORS
 import pymongo
-from gridfs import GridFS
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+from gridfs import GridFS, GridFSBucket
 from werkzeug.utils import secure_filename
-from openpyxl import Workbook
-from graph_upload_server import analyze_chart
-from extract_toc import find_toc_page_range, extract_toc_entries, build_topic_map
-from spreadsheet_analysis import analyze_spreadsheet_auto_merge
+from graph_upload_server import analyze_chart_image, chart_payload
+from spreadsheet_analysis import analyze_spreadsheet_auto_merge, iter_spreadsheet_rows, row_dict
+from page_store import ensure_page_indexes, store_pages, delete_pages
+from text_search import (ensure_search_indexes, store_search_index, delete_search_index,
+                         bm25_search, make_snippet)
+from pdf_ingest import parse_pdf, mapping_document
+from pdf_store import (ensure_store_indexes, ensure_library_indexes, claim_mapping, release_mapping,
+                       record_library_change, GarbageCollector)
+from jobs import JobQueue, InlineJob, QueueFull
+from azure_limits import throttle_metrics
+from excel_export import XLSX_MIMETYPE, xlsx_file, check_indexes, pick_sheet, iter_csv, iter_ndjson
 
 # --- CONFIG ---
 MONGO_URI    = "mongodb://localhost:27017/"
 DB_NAME      = "pdf_bot"
 PDF_BUCKET   = "pdfs"       # GridFS bucket name
-MAPPING_COLL = "mappings"   # Stores { topic_map: {...} }
-INDEX_COLL   = "index"      # Stores { filename, mapping_id }
+MAPPING_COLL = "mappings"   # Stores { sha256, file_id, topic_map: {...} }, one per PDF content
+INDEX_COLL   = "index"      # Stores { filename, sha256, mapping_id, file_id }
+PAGE_COLL    = "pages"      # Stores { mapping_id, page, text }
+POSTING_COLL = "search_postings"  # Stores { mapping_id, term, pages, tfs }
+JOB_COLL     = "jobs"       # Stores { kind, status, progress, result, error }
+META_COLL    = "meta"       # Stores { _id: "library", version }
+CHANGE_COLL  = "library_changes"  # Stores { _id: version, filename, mapping_id }
+LIBRARY_CHANGE_TTL_DAYS = 7  # readers further behind than this reload everything
+JOB_IO_WORKERS  = int(os.getenv("JOB_IO_WORKERS", 8))
+JOB_CPU_WORKERS = int(os.getenv("JOB_CPU_WORKERS", os.cpu_count()))
+JOB_MAX_PENDING = int(os.getenv("JOB_MAX_PENDING", 64))
+GRAPH_BATCH_CONCURRENCY = int(os.getenv("GRAPH_BATCH_CONCURRENCY", 8))  # in-flight Azure calls
+GRAPH_BATCH_MAX_IMAGES  = int(os.getenv("GRAPH_BATCH_MAX_IMAGES", 200))
+GRAPH_BATCH_MAX_BYTES   = int(os.getenv("GRAPH_BATCH_MAX_BYTES", 256 * 1024 * 1024))  # images, uncompressed
+IMAGE_EXTS = (".png", ".jpg", ".jpeg")
+UPLOAD_CHUNK = 1024 * 1024  # bytes copied per read while receiving a PDF
+GC_GRACE_HOURS = float(os.getenv("GC_GRACE_HOURS", 24))  # unreferenced mappings kept this long
+GC_INTERVAL    = float(os.getenv("GC_INTERVAL", 3600))   # seconds between collection runs
 # ----------------
 
 # set up logging
@@ -33,8 +60,141 @@ CORS(app)
 client = pymongo.MongoClient(MONGO_URI)
 db     = client[DB_NAME]
 fs     = GridFS(db, collection=PDF_BUCKET)
+bucket = GridFSBucket(db, bucket_name=PDF_BUCKET)
 maps   = db[MAPPING_COLL]
 idx    = db[INDEX_COLL]
+pages  = db[PAGE_COLL]
+postings = db[POSTING_COLL]
+ensure_page_indexes(pages)
+ensure_search_indexes(postings)
+ensure_store_indexes(maps, idx)
+meta    = db[META_COLL]
+changes = db[CHANGE_COLL]
+ensure_library_indexes(changes, LIBRARY_CHANGE_TTL_DAYS)
+gc = GarbageCollector(maps, idx, pages, postings, fs, GC_GRACE_HOURS, GC_INTERVAL).start()
+jobs   = JobQueue(db[JOB_COLL], JOB_IO_WORKERS, JOB_CPU_WORKERS, JOB_MAX_PENDING)
+# Shared by all /upload_graphs requests, so the cap holds across batches
+graph_pool = ThreadPoolExecutor(GRAPH_BATCH_CONCURRENCY, thread_name_prefix="graph")
+
+def wants_async():
+    return request.args.get("async", "").lower() in ("1", "true", "yes")
+
+
+def submit_job(kind, fn, *args):
+    """Queue `fn` on the job queue and answer 202 with the job's status URL."""
+    try:
+        job_id = jobs.submit(kind, fn, *args)
+    except QueueFull as e:
+        return jsonify({"error": str(e), "ok": False}), 503
+    return jsonify({"ok": True, "job_id": job_id, "status_url": f"/jobs/{job_id}"}), 202
+
+
+def receive_pdf(file):
+    """
+    Copy an uploaded PDF to a temp file in UPLOAD_CHUNK pieces, hashing it
+    on the way, so memory stays at one chunk whatever the file size.
+    Returns (sha256, tmp_path).
+    """
+    sha = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(suffix=".pdf")
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            for chunk in iter(lambda: file.stream.read(UPLOAD_CHUNK), b""):
+                sha.update(chunk)
+                tmp.write(chunk)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return sha.hexdigest(), tmp_path
+
+
+def link_filename(filename, map_doc, duplicate=False):
+    """Point `filename` at a finished mapping and release the one it replaces."""
+    previous = idx.find_one_and_replace(
+        {"filename": filename},
+        {"filename": filename, "sha256": map_doc["sha256"],
+         "mapping_id": map_doc["_id"], "file_id": map_doc["file_id"]},
+        upsert=True
+    )
+    if not previous or previous.get("mapping_id") != map_doc["_id"]:
+        record_library_change(meta, changes, filename, map_doc["_id"])
+    if previous and previous.get("mapping_id") != map_doc["_id"]:
+        release_mapping(maps, idx, previous.get("mapping_id"))
+        if "file_id" not in previous:
+            # uploads from before content addressing kept their blob by name
+            for old in fs.find({"filename": filename, "metadata.sha256": {"$exists": False}}):
+                fs.delete(old._id)
+
+    topic_map = map_doc.get("topic_map", {})
+    result = {
+        "message": "Upload successful",
+        "filename": filename,
+        "mapping_id": str(map_doc["_id"]),
+        "ok": True,
+        "toc_found": bool(topic_map),
+        "toc_backend": map_doc.get("toc_backend")
+    }
+    if duplicate:
+        result["duplicate"] = True
+    return result
+
+
+def process_pdf_upload(job, filename, sha256, tmp_path):
+    """GridFS write, ToC scan and page text store for a PDF not seen before."""
+    file_id = None
+    try:
+        job.progress("storing")
+        with open(tmp_path, "rb") as f:
+            file_id = bucket.upload_from_stream(filename, f, metadata={"sha256": sha256})
+
+        job.progress("parsing")
+        parsed = job.run_cpu(parse_pdf, tmp_path)
+    except Exception:
+        if file_id is not None:
+            fs.delete(file_id)
+        raise
+    finally:
+        os.remove(tmp_path)
+
+    toc = parsed["toc"]
+    topic_map = toc["topic_map"]
+    if topic_map:
+        log.info("Extracted %d ToC entries via %s", len(topic_map), toc["backend"])
+    else:
+        log.warning("No TOC detected in %s. Saving empty topic_map.", filename)
+
+    job.progress("indexing")
+    page_texts = parsed["page_texts"]
+    # pages and postings go in first so a mapping found by sha256 is complete
+    mapping_id = ObjectId()
+    store_pages(pages, mapping_id, page_texts)
+    store_search_index(postings, mapping_id, parsed["postings"])
+    mapping_doc = mapping_document(mapping_id, sha256, file_id, parsed)
+    try:
+        maps.insert_one(mapping_doc)
+    except DuplicateKeyError:
+        # an identical upload finished first; use its mapping
+        delete_pages(pages, mapping_id)
+        delete_search_index(postings, mapping_id)
+        fs.delete(file_id)
+        existing = claim_mapping(maps, sha256)
+        if existing is None:
+            raise
+        return link_filename(filename, existing, duplicate=True)
+
+    return link_filename(filename, mapping_doc)
+
+
+def process_graph_upload(job, image_bytes):
+    job.progress("analyzing")
+    return chart_payload(*analyze_chart_image(image_bytes))
+
+
+def process_sheet_upload(job, pdf_bytes, filename):
+    job.progress("analyzing")
+    data = analyze_spreadsheet_auto_merge(pdf_bytes, filename)
+    return {"ok": True, "data": data}
+
 
 @app.route("/upload", methods=["POST"])
 def upload_file():
@@ -47,55 +207,27 @@ def upload_file():
     if not filename or not filename.lower().endswith(".pdf"):
         return jsonify({"error": "Invalid file", "ok": False}), 400
 
+    tmp_path = None   # removed below unless handed to process_pdf_upload
     try:
-        existing = fs.find_one({"filename": filename})
+        sha256, tmp_path = receive_pdf(file)
+        existing = claim_mapping(maps, sha256)
         if existing:
-            fs.delete(existing._id)
-
-        pdf_bytes = file.read()
-        pdf_id = fs.put(pdf_bytes, filename=filename)
-
-        fd, tmp_path = tempfile.mkstemp(suffix=".pdf")
-        os.close(fd)
-        with open(tmp_path, "wb") as tmp:
-            tmp.write(pdf_bytes)
-
-        toc_start, toc_end = find_toc_page_range(tmp_path)
-
-        if toc_start:
-            entries = extract_toc_entries(tmp_path, toc_start, toc_end)
-            topic_map = build_topic_map(entries)
-            log.info("Extracted %d ToC entries", len(topic_map))
-        else:
-            topic_map = {}
-            log.warning("No TOC detected in %s. Saving empty topic_map.", filename)
-
-        os.remove(tmp_path)
-
-        mapping_doc = {"topic_map": topic_map}
-        mapping_id = maps.insert_one(mapping_doc).inserted_id
-
-        idx.replace_one(
-            {"filename": filename},
-            {"filename": filename, "mapping_id": mapping_id},
-            upsert=True
-        )
+            return jsonify(link_filename(filename, existing, duplicate=True)), 200
 
-        return jsonify({
-            "message": "Upload successful",
-            "filename": filename,
-            "mapping_id": str(mapping_id),
-            "ok": True,
-            "toc_found": bool(toc_start)
-        }), 200
+        if wants_async():
+            resp = submit_job("upload", process_pdf_upload, filename, sha256, tmp_path)
+            if resp[1] == 202:
+                tmp_path = None
+            return resp
+        path, tmp_path = tmp_path, None
+        return jsonify(process_pdf_upload(InlineJob(), filename, sha256, path)), 200
 
     except Exception as e:
         log.exception("Error in upload")
-        try:
-            os.remove(tmp_path)
-        except Exception:
-            pass
         return jsonify({"error": f"Server error: {e}"}), 500
+    finally:
+        if tmp_path is not None:
+            os.remove(tmp_path)
 
 @app.route("/list_pdfs", methods=["GET"])
 def list_pdfs():
@@ -103,6 +235,36 @@ def list_pdfs():
     filenames = [doc["filename"] for doc in docs]
     return jsonify({"pdfs": filenames, "ok": True})
 
+@app.route("/search", methods=["GET"])
+def search_pdf():
+    """
+    Full-text BM25 search over one uploaded PDF:
+    ?pdf=<filename>&q=<query>[&k=5] -> best pages with snippets.
+    """
+    filename = request.args.get("pdf", "")
+    query = request.args.get("q", "").strip()
+    k = min(max(request.args.get("k", 5, type=int), 1), 50)
+    if not filename or not query:
+        return jsonify({"error": "Both 'pdf' and 'q' are required", "ok": False}), 400
+
+    idx_doc = idx.find_one({"filename": filename})
+    map_doc = maps.find_one({"_id": idx_doc["mapping_id"]},
+                            {"search_stats": 1}) if idx_doc else None
+    if not map_doc:
+        return jsonify({"error": f"No index entry for '{filename}'", "ok": False}), 404
+    if not map_doc.get("search_stats"):
+        return jsonify({"error": f"'{filename}' was uploaded before search existed; re-upload it",
+                        "ok": False}), 409
+
+    hits = bm25_search(postings, map_doc["_id"], map_doc["search_stats"], query, k)
+    texts = {d["page"]: d["text"] for d in pages.find(
+        {"mapping_id": map_doc["_id"], "page": {"$in": [p for p, _ in hits]}},
+        {"_id": 0, "page": 1, "text": 1}
+    )}
+    results = [{"page": p, "score": round(score, 4), "snippet": make_snippet(texts.get(p, ""), query)}
+               for p, score in hits]
+    return jsonify({"ok": True, "pdf": filename, "query": query, "results": results})
+
 @app.route("/upload_graph", methods=["POST"])
 def upload_graph():
     log.info("Received /upload_graph request")
@@ -111,51 +273,108 @@ def upload_graph():
 
     file = request.files["file"]
     filename = secure_filename(file.filename)
-    if not filename.lower().endswith((".png", ".jpg", ".jpeg")):
+    if not filename.lower().endswith(IMAGE_EXTS):
         return jsonify({"error": "Invalid file type. Only PNG/JPG allowed.", "ok": False}), 400
 
     try:
-        fd, tmp_path = tempfile.mkstemp(suffix=os.path.splitext(filename)[1])
-        os.close(fd)
-        with open(tmp_path, "wb") as tmp_file:
-            tmp_file.write(file.read())
+        image_bytes = file.read()
+        if wants_async():
+            return submit_job("graph", process_graph_upload, image_bytes)
+        return jsonify(process_graph_upload(InlineJob(), image_bytes)), 200
 
-        result = analyze_chart(tmp_path)
-        raw_content = result["choices"][0]["message"]["content"]
-        log.info("Azure raw response:\n%s", raw_content)
+    except Exception as e:
+        log.exception("Error in /upload_graph")
+        return jsonify({"error": f"Server error: {e}", "ok": False}), 500
 
-        import re
-        json_str = re.sub(r"```json|```", "", raw_content).strip()
+class BatchTooLarge(ValueError):
+    pass
 
-        data = json.loads(json_str)
-        os.remove(tmp_path)
 
-        raw_pts = data.get("data_points") or data.get("dataPoints") or []
-        if isinstance(raw_pts, list):
-            flat_points = raw_pts
-        elif isinstance(raw_pts, dict):
-            flat_points = [{"label": k, "value": v} for k, v in raw_pts.items()]
-        else:
-            flat_points = []
+def collect_batch_images(files):
+    """
+    (filename, bytes) for every image upload, expanding .zip archives.
+    Raises BatchTooLarge past GRAPH_BATCH_MAX_IMAGES images or
+    GRAPH_BATCH_MAX_BYTES in total; zip members are counted from the
+    archive directory before any of them is decompressed.
+    """
+    images = []
+    total = 0
+
+    def admit(count, size):
+        nonlocal total
+        total += size
+        if len(images) + count > GRAPH_BATCH_MAX_IMAGES:
+            raise BatchTooLarge(f"At most {GRAPH_BATCH_MAX_IMAGES} images per batch")
+        if total > GRAPH_BATCH_MAX_BYTES:
+            raise BatchTooLarge(f"At most {GRAPH_BATCH_MAX_BYTES} bytes of images per batch")
+
+    for file in files:
+        name = secure_filename(file.filename or "")
+        if name.lower().endswith(".zip"):
+            with zipfile.ZipFile(file.stream) as zf:
+                members = [info for info in zf.infolist()
+                           if not info.is_dir() and info.filename.lower().endswith(IMAGE_EXTS)]
+                admit(len(members), sum(info.file_size for info in members))
+                for info in members:
+                    images.append((os.path.basename(info.filename), zf.read(info)))
+        elif name.lower().endswith(IMAGE_EXTS):
+            admit(1, 0)
+            data = file.read()
+            admit(0, len(data))
+            images.append((name, data))
+    return images
+
+
+def analyze_batch_image(filename, image_bytes):
+    try:
+        return {"filename": filename, **chart_payload(*analyze_chart_image(image_bytes))}
+    except Exception as e:
+        log.exception("Error analyzing %s in /upload_graphs", filename)
+        return {"filename": filename, "error": f"Server error: {e}", "ok": False}
+
 
-        return jsonify({
-            "ok": True,
-            "raw": data,  # full original parsed content
-            "title": data.get("title"),
-            "x_axis_label": data.get("x_axis_label") or data.get("axes", {}).get("x"),
-            "y_axis_label": data.get("y_axis_label") or data.get("axes", {}).get("y"),
-            "data": data.get("data", []),
-            "dataPoints": flat_points
-        }), 200
+@app.route("/upload_graphs", methods=["POST"])
+def upload_graphs():
+    """
+    Batch chart analysis: many PNG/JPG files (multipart field "files") or
+    zip archives of them. Streams one NDJSON line per image, in completion
+    order, each tagged with its position in the upload.
+    """
+    log.info("Received /upload_graphs request")
+    try:
+        images = collect_batch_images(request.files.getlist("files"))
+    except zipfile.BadZipFile as e:
+        return jsonify({"error": f"Invalid zip: {e}", "ok": False}), 400
+    except BatchTooLarge as e:
+        return jsonify({"error": str(e), "ok": False}), 400
+    if not images:
+        return jsonify({"error": "No PNG/JPG files in upload", "ok": False}), 400
+
+    futures = {graph_pool.submit(analyze_batch_image, name, data): i
+               for i, (name, data) in enumerate(images)}
 
+    def stream():
+        for fut in as_completed(futures):
+            yield json.dumps({"index": futures[fut], **fut.result()}) + "\n"
 
+    return Response(stream(), mimetype="application/x-ndjson")
+
+def stream_sheet_rows(pdf_bytes, filename):
+    """
+    NDJSON for /upload_sheet?stream=1: one { sheet, index, cells } line per
+    row as pages are merged, then { ok, done, rows }, or { ok: false,
+    error } if the analysis fails part-way.
+    """
+    count = 0
+    try:
+        for row in iter_spreadsheet_rows(pdf_bytes, filename):
+            yield json.dumps({"sheet": "Sheet1", **row_dict(row)}) + "\n"
+            count += 1
     except Exception as e:
-        log.exception("Error in /upload_graph")
-        try:
-            os.remove(tmp_path)
-        except Exception:
-            pass
-        return jsonify({"error": f"Server error: {e}", "ok": False}), 500
+        log.exception("Error in /upload_sheet?stream=1")
+        yield json.dumps({"ok": False, "error": str(e)}) + "\n"
+        return
+    yield json.dumps({"ok": True, "done": True, "rows": count}) + "\n"
 
 @app.route("/upload_sheet", methods=["POST"])
 def upload_sheet_merged():
@@ -168,47 +387,72 @@ def upload_sheet_merged():
         return jsonify({"error": "Only PDF allowed"}), 400
 
     pdf_bytes = file.read()
+    if request.args.get("stream", "").lower() in ("1", "true", "yes"):
+        return Response(stream_sheet_rows(pdf_bytes, filename), mimetype="application/x-ndjson")
+    if wants_async():
+        return submit_job("sheet", process_sheet_upload, pdf_bytes, filename)
     try:
-        data = analyze_spreadsheet_auto_merge(pdf_bytes, filename)
-        return jsonify({"ok": True, "data": data}), 200
+        return jsonify(process_sheet_upload(InlineJob(), pdf_bytes, filename)), 200
     except Exception as e:
         log.exception("Error in /upload_sheet/merged")
         return jsonify({"error": str(e), "ok": False}), 500
 
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if not job:
+        return jsonify({"error": "Unknown job", "ok": False}), 404
+    body = {
+        "ok": True,
+        "job_id": job["_id"],
+        "kind": job["kind"],
+        "status": job["status"],
+        "progress": job.get("progress"),
+    }
+    if job["status"] == "done":
+        body["result"] = job["result"]
+    elif job["status"] == "failed":
+        body["error"] = job["error"]
+    return jsonify(body), 200
+
+@app.route("/azure_metrics", methods=["GET"])
+def azure_metrics():
+    """Per-service call, throttle and retry counters of the Azure clients."""
+    return jsonify({"ok": True, "services": throttle_metrics()})
+
 @app.route("/getexcel", methods=["POST"])
 def get_excel():
     """
     Accepts JSON payload in the same format as the analyzer output,
-    returns an .xlsx file for download.
+    returns an .xlsx file for download (?format=csv or ?format=ndjson
+    stream the rows instead; csv takes ?sheet=, default the active one).
     """
     data = request.get_json()
-    # Build workbook
-    wb = Workbook()
-    wb.remove(wb.active)
-    for sheet in data.get("sheets", []):
-        ws = wb.create_sheet(title=sheet.get("name", "Sheet"))
-        for row in sheet.get("rows", []):
-            for cell in row.get("cells", []):
-                if cell.get("enable", False):
-                    ws.cell(
-                        row=row.get("index"),
-                        column=cell.get("index"),
-                        value=cell.get("value")
-                    )
-    # Activate sheet
-    active = data.get("activeSheet")
-    if active in wb.sheetnames:
-        wb.active = wb[active]
-    # Save to in-memory bytes buffer
-    output = io.BytesIO()
-    wb.save(output)
-    output.seek(0)
+    fmt = request.args.get("format", "xlsx").lower()
+    if fmt not in ("xlsx", "csv", "ndjson"):
+        return jsonify({"error": f"Unknown format '{fmt}'", "ok": False}), 400
+    try:
+        if fmt == "xlsx":
+            output = xlsx_file(data)
+        else:
+            check_indexes(data)
+    except ValueError as e:
+        return jsonify({"error": str(e), "ok": False}), 400
+
+    if fmt == "csv":
+        return Response(
+            iter_csv(pick_sheet(data, request.args.get("sheet"))),
+            mimetype="text/csv",
+            headers={"Content-Disposition": "attachment; filename=output.csv"}
+        )
+    if fmt == "ndjson":
+        return Response(iter_ndjson(data), mimetype="application/x-ndjson")
     # Send as downloadable file
     return send_file(
         output,
         as_attachment=True,
         download_name="output.xlsx",
-        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        mimetype=XLSX_MIMETYPE
     )
 
 
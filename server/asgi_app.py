@@ -0,0 +1,278 @@
+# server/asgi_app.py
+"""
+ASGI serving mode. The Azure-bound endpoints (/upload_graph,
+/upload_graphs, /upload_sheet) run as coroutines on async HTTP, Azure
+and Mongo clients, so one process keeps hundreds of Azure calls in flight.
+Every other route, and any request with ?async=1 (the job queue), is
+passed to the Flask app in app.py unchanged.
+
+    cd server; uvicorn asgi_app:application --port 5001
+"""
+import os
+import io
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import zipfile
+from urllib.parse import parse_qs
+
+import httpx
+from a2wsgi import WSGIMiddleware
+from motor.motor_asyncio import AsyncIOMotorClient
+from quart import Quart, Response, request, jsonify
+from quart_cors import cors
+from werkzeug.utils import secure_filename
+from azure.ai.formrecognizer.aio import DocumentAnalysisClient
+from azure.core.credentials import AzureKeyCredential
+
+import app as wsgi_app
+import graph_upload_server as charts
+import spreadsheet_analysis as sheets
+
+# --- CONFIG ---
+ASGI_AZURE_CONCURRENCY = int(os.getenv("ASGI_AZURE_CONCURRENCY", 256))  # in-flight Azure calls per process
+ASGI_WSGI_THREADS      = int(os.getenv("ASGI_WSGI_THREADS", 16))        # threads serving the Flask routes
+ASYNC_ROUTES = {"/upload_graph", "/upload_graphs", "/upload_sheet"}
+# ----------------
+
+log = logging.getLogger(__name__)
+
+app = cors(Quart(__name__))
+
+# Created on the serving loop in startup()
+mongo = None
+http = None
+doc_client = None
+azure_slots = None
+chart_cache = None
+
+
+class AsyncChartResultCache(charts.ChartResultCache):
+    """ChartResultCache over a Motor collection; shares the in-process tier's rules."""
+
+    async def get(self, key):
+        hit = self.recall(key)
+        if hit is not None:
+            return hit
+        return self._remember_doc(key, await self.coll.find_one(self._fresh(key)))
+
+    async def put(self, key, result):
+        await self.coll.replace_one({"_id": key}, self._doc(key, result), upsert=True)
+        self._remember(key, result, time.time() + self.ttl)
+
+
+@app.before_serving
+async def startup():
+    global mongo, http, doc_client, azure_slots, chart_cache
+    mongo = AsyncIOMotorClient(charts.MONGO_URI)
+    http = httpx.AsyncClient(
+        timeout=httpx.Timeout(120.0, connect=10.0),
+        limits=httpx.Limits(max_connections=ASGI_AZURE_CONCURRENCY,
+                            max_keepalive_connections=ASGI_AZURE_CONCURRENCY)
+    )
+    doc_client = DocumentAnalysisClient(
+        endpoint=sheets.DOC_INTEL_ENDPOINT,
+        credential=AzureKeyCredential(sheets.DOC_INTEL_KEY)
+    )
+    azure_slots = asyncio.Semaphore(ASGI_AZURE_CONCURRENCY)
+    chart_cache = AsyncChartResultCache(mongo[charts.DB_NAME][charts.cache_coll.name],
+                                        charts.CHART_CACHE_SIZE, charts.CHART_CACHE_TTL)
+
+
+@app.after_serving
+async def shutdown():
+    await http.aclose()
+    await doc_client.close()
+    mongo.close()
+
+
+# --- charts ---
+
+async def analyze_chart_image(image_bytes):
+    """Async twin of graph_upload_server.analyze_chart_image."""
+    cache_key = charts.ChartResultCache.key_for(image_bytes)
+    cached = await chart_cache.get(cache_key)
+    if cached is not None:
+        return cached, {"cached": True, "original_bytes": len(image_bytes)}
+
+    # decoding and downscaling is CPU work; keep it off the loop
+    url, headers, payload, stats = await asyncio.to_thread(charts.chart_request, image_bytes)
+    async with azure_slots:
+        response = await charts.openai_throttle.acall(post_checked, url, headers=headers, json=payload)
+    result = response.json()
+
+    await mongo[charts.DB_NAME][charts.graph_coll.name].insert_one(dict(result))
+    await chart_cache.put(cache_key, result)
+    return result, stats
+
+
+async def post_checked(url, **kwargs):
+    response = await http.post(url, **kwargs)
+    response.raise_for_status()
+    return response
+
+
+async def analyze_batch_image(filename, image_bytes):
+    try:
+        return {"filename": filename, **charts.chart_payload(*await analyze_chart_image(image_bytes))}
+    except Exception as e:
+        log.exception("Error analyzing %s in /upload_graphs", filename)
+        return {"filename": filename, "error": f"Server error: {e}", "ok": False}
+
+
+@app.route("/upload_graph", methods=["POST"])
+async def upload_graph():
+    log.info("Received /upload_graph request")
+    files = await request.files
+    if "file" not in files:
+        return jsonify({"error": "No file part", "ok": False}), 400
+
+    file = files["file"]
+    filename = secure_filename(file.filename)
+    if not filename.lower().endswith(wsgi_app.IMAGE_EXTS):
+        return jsonify({"error": "Invalid file type. Only PNG/JPG allowed.", "ok": False}), 400
+
+    try:
+        return jsonify(charts.chart_payload(*await analyze_chart_image(file.read()))), 200
+    except Exception as e:
+        log.exception("Error in /upload_graph")
+        return jsonify({"error": f"Server error: {e}", "ok": False}), 500
+
+
+@app.route("/upload_graphs", methods=["POST"])
+async def upload_graphs():
+    """Same contract as the Flask route: NDJSON lines in completion order."""
+    log.info("Received /upload_graphs request")
+    files = await request.files
+    try:
+        # reading and unzipping up to GRAPH_BATCH_MAX_BYTES would stall the event loop
+        images = await asyncio.to_thread(wsgi_app.collect_batch_images, files.getlist("files"))
+    except zipfile.BadZipFile as e:
+        return jsonify({"error": f"Invalid zip: {e}", "ok": False}), 400
+    except wsgi_app.BatchTooLarge as e:
+        return jsonify({"error": str(e), "ok": False}), 400
+    if not images:
+        return jsonify({"error": "No PNG/JPG files in upload", "ok": False}), 400
+
+    async def indexed(i, name, data):
+        return i, await analyze_batch_image(name, data)
+
+    tasks = [asyncio.ensure_future(indexed(i, name, data)) for i, (name, data) in enumerate(images)]
+
+    async def stream():
+        try:
+            for done in asyncio.as_completed(tasks):
+                i, body = await done
+                yield json.dumps({"index": i, **body}) + "\n"
+        finally:
+            for t in tasks:
+                t.cancel()
+
+    return Response(stream(), mimetype="application/x-ndjson")
+
+
+# --- spreadsheets ---
+
+async def analyze_layout(stream):
+    async def run():
+        stream.seek(0)
+        poller = await doc_client.begin_analyze_document(
+            sheets.LAYOUT_MODEL, document=stream, retry_total=0)
+        return await poller.result()
+
+    async with azure_slots:
+        result = await sheets.layout_throttle.acall(run)
+    return sheets.page_layouts(result)
+
+
+async def load_page_layouts(pdf_bytes):
+    """Async twin of spreadsheet_analysis.load_page_layouts."""
+    try:
+        reader, hashes = await asyncio.to_thread(sheets.fingerprint_pages, pdf_bytes)
+    except Exception:
+        log.warning("Could not fingerprint PDF pages; analyzing without the page cache", exc_info=True)
+        return await analyze_layout(io.BytesIO(pdf_bytes))
+
+    page_coll = mongo[sheets.DB_NAME][sheets.page_coll.name]
+    layouts = {d["_id"]: d["layout"]
+               async for d in page_coll.find({"_id": {"$in": list(set(hashes))}})}
+    todo = sheets.pages_to_analyze(hashes, layouts)
+    if todo:
+        log.info("Layout cache: %d of %d pages need analysis", len(todo), len(hashes))
+        windows = await asyncio.to_thread(sheets.layout_windows, pdf_bytes, reader, todo)
+        window_slots = asyncio.Semaphore(sheets.LAYOUT_MAX_IN_FLIGHT)
+
+        async def analyze_window(pages, stream):
+            async with window_slots:
+                return sheets.check_window(await analyze_layout(stream), pages)
+
+        results = await asyncio.gather(*(analyze_window(p, s) for p, s in windows))
+        fresh = [lay for window in results for lay in window]
+        await page_coll.bulk_write(sheets.cache_writes(hashes, todo, fresh), ordered=False)
+        layouts.update({hashes[i]: lay for i, lay in zip(todo, fresh)})
+
+    return [layouts[h] for h in hashes]
+
+
+async def analyze_spreadsheet_auto_merge(pdf_bytes, file_name):
+    """Async twin of spreadsheet_analysis.analyze_spreadsheet_auto_merge."""
+    coll = mongo[sheets.DB_NAME][sheets.coll.name]
+    pdf_hash = hashlib.sha256(pdf_bytes).hexdigest()
+    cached = await coll.find_one(sheets.cached_result_filter(pdf_hash), {"data": 1})
+    if cached:
+        return cached["data"]
+
+    layouts = await load_page_layouts(pdf_bytes)
+    data = await asyncio.to_thread(sheets.sheet_data, layouts)
+    await coll.replace_one(
+        {"sha256": pdf_hash},
+        sheets.result_document(file_name, pdf_hash, data),
+        upsert=True
+    )
+    return data
+
+
+@app.route("/upload_sheet", methods=["POST"])
+async def upload_sheet_merged():
+    files = await request.files
+    if "file" not in files:
+        return jsonify({"error": "No file part"}), 400
+
+    file = files["file"]
+    filename = secure_filename(file.filename)
+    if not filename.lower().endswith(".pdf"):
+        return jsonify({"error": "Only PDF allowed"}), 400
+
+    try:
+        data = await analyze_spreadsheet_auto_merge(file.read(), filename)
+        return jsonify({"ok": True, "data": data}), 200
+    except Exception as e:
+        log.exception("Error in /upload_sheet/merged")
+        return jsonify({"error": str(e), "ok": False}), 500
+
+
+# --- dispatch ---
+
+flask_app = WSGIMiddleware(wsgi_app.app, workers=ASGI_WSGI_THREADS)
+
+
+def wsgi_only(scope):
+    """Job submissions (?async=1) and streamed sheets (?stream=1) stay on Flask."""
+    query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    return any(query.get(flag, [""])[-1].lower() in ("1", "true", "yes")
+               for flag in ("async", "stream"))
+
+
+async def application(scope, receive, send):
+    """Azure-bound routes to Quart, the rest (and job submissions) to Flask."""
+    if scope["type"] == "http" and (scope["path"] not in ASYNC_ROUTES or wsgi_only(scope)):
+        await flask_app(scope, receive, send)
+    else:
+        await app(scope, receive, send)
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(application, port=5001)
@@ -0,0 +1,231 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+
+log = logging.getLogger(__name__)
+
+# Errors raised before any HTTP status came back (connection refused or
+# reset, DNS, timeouts), as each client library spells them.
+TRANSIENT_ERRORS = [ConnectionError, TimeoutError]
+try:
+    import requests
+    TRANSIENT_ERRORS += [requests.ConnectionError, requests.Timeout]
+except ImportError:
+    pass
+try:
+    import httpx
+    TRANSIENT_ERRORS.append(httpx.TransportError)
+except ImportError:
+    pass
+try:
+    from azure.core.exceptions import ServiceRequestError, ServiceResponseError
+    TRANSIENT_ERRORS += [ServiceRequestError, ServiceResponseError]
+except ImportError:
+    pass
+TRANSIENT_ERRORS = tuple(TRANSIENT_ERRORS)
+
+THROTTLE_STATUSES = (429, 503)            # Azure asking us to slow down
+RETRY_STATUSES    = (429, 500, 502, 503, 504)
+AZURE_MAX_RETRIES = int(os.getenv("AZURE_MAX_RETRIES", 4))
+AZURE_BACKOFF_BASE = 0.5    # seconds, doubled per attempt, full jitter
+AZURE_BACKOFF_MAX  = 30.0
+AIMD_DECREASE = 0.5         # concurrency limit factor on a throttle
+AIMD_COOLDOWN = 1.0         # seconds between two decreases
+SLOT_POLL     = 0.05        # seconds between checks for a free slot
+
+
+def _status(exc):
+    """HTTP status of a requests/httpx/azure-core error, if it has one."""
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    return status
+
+
+def retry_after(exc):
+    """Seconds the service asked us to wait, from the error's response headers."""
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    if not headers:
+        return None
+    for name, scale in (("retry-after-ms", 1000.0), ("x-ms-retry-after-ms", 1000.0)):
+        value = headers.get(name)
+        if value:
+            try:
+                return float(value) / scale
+            except ValueError:
+                pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class AzureThrottle:
+    """
+    Client-side limits for one Azure service, shared by every thread and
+    event loop in the process: a token bucket of `rate` calls per second
+    (bursts up to `burst`), a concurrency limit adjusted AIMD-style
+    (+1/limit per success, halved on a throttle), a global pause when the
+    service sends Retry-After, and jittered retries of transient errors.
+    """
+
+    def __init__(self, name, rate, burst, max_concurrency, min_concurrency=1,
+                 max_retries=AZURE_MAX_RETRIES):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_retries = max_retries
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._refilled = time.monotonic()
+        self._pause_until = 0.0
+        self._limit = float(max_concurrency)
+        self._last_decrease = 0.0
+        self._in_flight = 0
+        self._metrics = {"calls": 0, "succeeded": 0, "failed": 0, "throttled": 0,
+                         "retries": 0, "waited_seconds": 0.0, "last_retry_after": None}
+
+    # --- admission ---
+
+    def _try_acquire(self):
+        """Take a token and a slot and return 0, or return seconds to wait."""
+        now = time.monotonic()
+        with self._lock:
+            if now < self._pause_until:
+                return self._pause_until - now
+            if self._in_flight >= int(self._limit):
+                return SLOT_POLL
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+            self._refilled = now
+            if self._tokens < 1:
+                return (1 - self._tokens) / self.rate
+            self._tokens -= 1
+            self._in_flight += 1
+            return 0
+
+    def _release(self, status=None, wait=None):
+        now = time.monotonic()
+        with self._lock:
+            self._in_flight -= 1
+            if status is None:
+                self._limit = min(self.max_concurrency, self._limit + 1 / self._limit)
+                self._metrics["succeeded"] += 1
+                return
+            if status in THROTTLE_STATUSES:
+                self._metrics["throttled"] += 1
+                if now - self._last_decrease >= AIMD_COOLDOWN:
+                    self._limit = max(self.min_concurrency, self._limit * AIMD_DECREASE)
+                    self._last_decrease = now
+                if wait is not None:
+                    self._metrics["last_retry_after"] = wait
+                    self._pause_until = max(self._pause_until, now + wait)
+
+    def _backoff(self, attempt, wait):
+        if wait is not None:
+            return wait + random.uniform(0, AZURE_BACKOFF_BASE)
+        return random.uniform(0, min(AZURE_BACKOFF_MAX, AZURE_BACKOFF_BASE * 2 ** attempt))
+
+    def _failed(self, exc, attempt):
+        """Seconds to sleep before retrying `exc`, or None to give up."""
+        status = _status(exc)
+        retryable = status in RETRY_STATUSES or isinstance(exc, TRANSIENT_ERRORS)
+        wait = retry_after(exc) if status in THROTTLE_STATUSES else None
+        self._release(status if status is not None else 0, wait)
+        if not retryable or attempt >= self.max_retries:
+            with self._lock:
+                self._metrics["failed"] += 1
+            return None
+        with self._lock:
+            self._metrics["retries"] += 1
+        log.info("%s: %s, retry %d/%d", self.name, f"HTTP {status}" if status else type(exc).__name__,
+                 attempt + 1, self.max_retries)
+        return self._backoff(attempt, wait)
+
+    def _count_wait(self, seconds):
+        with self._lock:
+            self._metrics["waited_seconds"] += seconds
+
+    # --- calls ---
+
+    def call(self, fn, *args, **kwargs):
+        """fn(*args, **kwargs) under the limits, retried on throttles and 5xx."""
+        with self._lock:
+            self._metrics["calls"] += 1
+        attempt = 0
+        while True:
+            while (wait := self._try_acquire()) > 0:
+                self._count_wait(wait)
+                time.sleep(wait)
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as exc:
+                delay = self._failed(exc, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            except BaseException:
+                self._release(0)   # cancelled: free the slot, count nothing
+                raise
+            self._release()
+            return result
+
+    async def acall(self, fn, *args, **kwargs):
+        """Coroutine version of call(); `fn` returns an awaitable."""
+        with self._lock:
+            self._metrics["calls"] += 1
+        attempt = 0
+        while True:
+            while (wait := self._try_acquire()) > 0:
+                self._count_wait(wait)
+                await asyncio.sleep(wait)
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as exc:
+                delay = self._failed(exc, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            except BaseException:
+                self._release(0)   # cancelled: free the slot, count nothing
+                raise
+            self._release()
+            return result
+
+    def snapshot(self):
+        with self._lock:
+            return {**self._metrics,
+                    "waited_seconds": round(self._metrics["waited_seconds"], 3),
+                    "concurrency_limit": round(self._limit, 2),
+                    "in_flight": self._in_flight,
+                    "paused_for": round(max(0.0, self._pause_until - time.monotonic()), 3)}
+
+
+_throttles = {}
+
+
+def get_throttle(name, rate, burst, max_concurrency):
+    """The process-wide throttle for `name`, created on first use."""
+    if name not in _throttles:
+        _throttles[name] = AzureThrottle(name, rate, burst, max_concurrency)
+    return _throttles[name]
+
+
+def throttle_metrics():
+    return {name: t.snapshot() for name, t in _throttles.items()}
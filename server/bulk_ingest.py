@@ -0,0 +1,387 @@
+# server/bulk_ingest.py
+"""
+Offline bulk ingestion: the same GridFS blobs, mappings, pages, search
+postings and index entries /upload writes, for a whole directory (or a
+manifest listing one PDF path per line) at a time. PDFs are hashed and
+parsed on a process pool and written in batches with insert_many.
+
+    cd server; python bulk_ingest.py /data/pdfs --workers 8
+    python bulk_ingest.py pdfs.txt --json-out ../rasa_backend --no-mongo
+
+Re-running skips every PDF whose content is already stored, so an
+interrupted run picks up where it stopped. --json-out also writes
+mappings/<name>_<sha256[:8]>.json and master_index.json under the
+given directory.
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import pymongo
+from bson import ObjectId
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
+from gridfs import GridFS, GridFSBucket
+
+from pdf_ingest import parse_pdf, mapping_document
+from page_store import ensure_page_indexes, page_documents, delete_pages
+from text_search import ensure_search_indexes, posting_documents, delete_search_index
+from pdf_store import (ensure_store_indexes, ensure_library_indexes, claim_mapping, release_mapping,
+                       record_library_change)
+
+# --- CONFIG must match app.py ---
+MONGO_URI    = "mongodb://localhost:27017/"
+DB_NAME      = "pdf_bot"
+PDF_BUCKET   = "pdfs"
+MAPPING_COLL = "mappings"
+INDEX_COLL   = "index"
+PAGE_COLL    = "pages"
+POSTING_COLL = "search_postings"
+META_COLL    = "meta"
+CHANGE_COLL  = "library_changes"
+LIBRARY_CHANGE_TTL_DAYS = 7
+BULK_WORKERS = int(os.getenv("BULK_WORKERS", os.cpu_count()))
+BULK_BATCH   = int(os.getenv("BULK_BATCH", 32))  # parsed PDFs per bulk write
+HASH_CHUNK   = 1024 * 1024
+LOOKUP_CHUNK = 1000   # hashes per existing-mapping query
+# ----------------
+
+log = logging.getLogger(__name__)
+
+
+def list_pdfs(source):
+    """PDFs under a directory, or the paths listed in a manifest file (relative to it)."""
+    if os.path.isdir(source):
+        return sorted(os.path.join(root, name)
+                      for root, _, names in os.walk(source)
+                      for name in names if name.lower().endswith(".pdf"))
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source, encoding="utf-8") as f:
+        lines = [ln.strip() for ln in f]
+    return [os.path.join(base, ln) for ln in lines if ln and not ln.startswith("#")]
+
+
+def unique_names(paths, stats):
+    """
+    `paths` without those whose file name an earlier path already has.
+    Index entries are keyed by file name, as /upload keys them, so a
+    second PDF of that name (elsewhere in the tree) would take over the
+    first one's entry.
+    """
+    first = {}
+    kept = []
+    for path in paths:
+        name = os.path.basename(path)
+        if name in first:
+            log.error("Skipping %s: %s is already ingested as %s", path, first[name], name)
+            stats["collisions"] += 1
+            continue
+        first[name] = path
+        kept.append(path)
+    return kept
+
+
+def file_sha256(path):
+    sha = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+                sha.update(chunk)
+    except OSError as e:
+        return path, None, str(e)
+    return path, sha.hexdigest(), None
+
+
+def hash_files(pool, paths, stats):
+    """sha256 -> paths with that content, in first-seen order."""
+    by_sha = {}
+    for path, sha, error in pool.map(file_sha256, paths, chunksize=16):
+        if sha is None:
+            log.error("Cannot read %s: %s", path, error)
+            stats["failed"] += 1
+            continue
+        by_sha.setdefault(sha, []).append(path)
+    return by_sha
+
+
+def iter_parsed(pool, todo, max_in_flight, stats):
+    """
+    (sha256, paths, parsed) in completion order, with at most
+    `max_in_flight` parses submitted so parsed text never piles up.
+    """
+    items = iter(todo.items())
+    pending = {}
+    while True:
+        for sha, paths in islice(items, max_in_flight - len(pending)):
+            pending[pool.submit(parse_pdf, paths[0])] = (sha, paths)
+        if not pending:
+            return
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for fut in done:
+            sha, paths = pending.pop(fut)
+            try:
+                parsed = fut.result()
+            except Exception as e:
+                log.error("Cannot parse %s: %s", paths[0], e)
+                stats["failed"] += len(paths)
+                continue
+            yield sha, paths, parsed
+
+
+def batches(items, size):
+    items = iter(items)
+    while batch := list(islice(items, size)):
+        yield batch
+
+
+class MongoStore:
+    """Bulk writes into the collections /upload uses."""
+
+    def __init__(self, db):
+        self.fs      = GridFS(db, collection=PDF_BUCKET)
+        self.bucket  = GridFSBucket(db, bucket_name=PDF_BUCKET)
+        self.maps    = db[MAPPING_COLL]
+        self.idx     = db[INDEX_COLL]
+        self.pages   = db[PAGE_COLL]
+        self.postings = db[POSTING_COLL]
+        self.meta    = db[META_COLL]
+        self.changes = db[CHANGE_COLL]
+        ensure_page_indexes(self.pages)
+        ensure_search_indexes(self.postings)
+        ensure_store_indexes(self.maps, self.idx)
+        ensure_library_indexes(self.changes, LIBRARY_CHANGE_TTL_DAYS)
+
+    def existing(self, shas):
+        """sha256 -> mapping already stored for it, taken back from the collector if released."""
+        found = {}
+        for doc in self.maps.find({"sha256": {"$in": shas}},
+                                  {"sha256": 1, "file_id": 1, "topic_map": 1, "released_at": 1}):
+            if "released_at" in doc:
+                doc = claim_mapping(self.maps, doc["sha256"])
+                if doc is None:
+                    continue
+            found[doc["sha256"]] = doc
+        return found
+
+    def clear_orphans(self, shas):
+        """
+        Blobs, pages and postings an interrupted run stored for content
+        that never got its mapping. Only this tool tags blobs with the
+        mapping id, so uploads in progress are left alone.
+        """
+        for shas_chunk in batches(shas, LOOKUP_CHUNK):
+            for blob in self.fs.find({"metadata.sha256": {"$in": shas_chunk},
+                                      "metadata.mapping_id": {"$exists": True}}):
+                delete_pages(self.pages, blob.metadata["mapping_id"])
+                delete_search_index(self.postings, blob.metadata["mapping_id"])
+                self.fs.delete(blob._id)
+
+    def write(self, batch):
+        """
+        Store a batch of parsed PDFs: blobs, then pages and postings, then
+        mappings, so a mapping found by sha256 is always complete.
+        Returns [(paths, map_doc)] to link.
+        """
+        docs, page_docs, posting_docs = [], [], []
+        for sha, paths, parsed in batch:
+            mapping_id = ObjectId()
+            with open(paths[0], "rb") as f:
+                file_id = self.bucket.upload_from_stream(
+                    os.path.basename(paths[0]), f,
+                    metadata={"sha256": sha, "mapping_id": mapping_id})
+            docs.append(mapping_document(mapping_id, sha, file_id, parsed))
+            page_docs += page_documents(mapping_id, parsed["page_texts"])
+            posting_docs += posting_documents(mapping_id, parsed["postings"])
+        if page_docs:
+            self.pages.insert_many(page_docs, ordered=False)
+        if posting_docs:
+            self.postings.insert_many(posting_docs, ordered=False)
+
+        lost = set()
+        try:
+            self.maps.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            if any(err["code"] != 11000 for err in e.details["writeErrors"]):
+                raise
+            # the same content was uploaded meanwhile; use that mapping
+            lost = {err["index"] for err in e.details["writeErrors"]}
+
+        linked = []
+        for i, ((sha, paths, _), doc) in enumerate(zip(batch, docs)):
+            if i in lost:
+                delete_pages(self.pages, doc["_id"])
+                delete_search_index(self.postings, doc["_id"])
+                self.fs.delete(doc["file_id"])
+                doc = claim_mapping(self.maps, sha)
+                if doc is None:
+                    log.error("Mapping for %s vanished; run again to retry it", paths[0])
+                    continue
+            linked.append((paths, doc))
+        return linked
+
+    def link(self, pairs):
+        """Point each path's filename at its mapping, as link_filename in app.py does."""
+        targets = {}
+        for paths, doc in pairs:
+            for path in paths:
+                targets[os.path.basename(path)] = doc
+        if not targets:
+            return 0
+        previous = {d["filename"]: d for d in self.idx.find({"filename": {"$in": list(targets)}})}
+        changed = [(name, doc) for name, doc in targets.items()
+                   if previous.get(name, {}).get("mapping_id") != doc["_id"]]
+        if not changed:
+            return 0
+        self.idx.bulk_write([
+            ReplaceOne({"filename": name},
+                       {"filename": name, "sha256": doc["sha256"],
+                        "mapping_id": doc["_id"], "file_id": doc["file_id"]},
+                       upsert=True)
+            for name, doc in changed
+        ], ordered=False)
+        for name, doc in changed:
+            record_library_change(self.meta, self.changes, name, doc["_id"])
+            old = previous.get(name)
+            if old:
+                release_mapping(self.maps, self.idx, old.get("mapping_id"))
+                if "file_id" not in old:
+                    for blob in self.fs.find({"filename": name, "metadata.sha256": {"$exists": False}}):
+                        self.fs.delete(blob._id)
+        return len(changed)
+
+
+class JsonStore:
+    """
+    mappings/*.json and master_index.json, as the Rasa backend reads them.
+    A mapping file that master_index.json stops pointing at (one written
+    under an older naming scheme, or for content since replaced) is
+    removed once the new index is saved, so re-runs leave no duplicates.
+    """
+
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+        self.master_path = os.path.join(out_dir, "master_index.json")
+        os.makedirs(os.path.join(out_dir, "mappings"), exist_ok=True)
+        self.master = {}
+        self.superseded = set()   # mapping files master_index.json pointed at before
+        if os.path.exists(self.master_path):
+            with open(self.master_path, encoding="utf-8") as f:
+                self.master = json.load(f)
+
+    @staticmethod
+    def mapping_file(path, sha):
+        stem = os.path.splitext(os.path.basename(path))[0]
+        return f"{stem.replace(' ', '_')}_{sha[:8]}.json"
+
+    def has(self, sha, paths):
+        name = self.mapping_file(paths[0], sha)
+        return (os.path.exists(os.path.join(self.out_dir, "mappings", name))
+                and all(self.master.get(os.path.basename(p)) == name for p in paths))
+
+    def write(self, sha, paths, topic_map):
+        name = self.mapping_file(paths[0], sha)
+        path = os.path.join(self.out_dir, "mappings", name)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(topic_map, f, indent=2, ensure_ascii=False)
+        for p in paths:
+            old = self.master.get(os.path.basename(p))
+            if old and old != name:
+                self.superseded.add(old)
+            self.master[os.path.basename(p)] = name
+
+    def save(self):
+        tmp = self.master_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.master, f, indent=2, ensure_ascii=False)
+        os.replace(tmp, self.master_path)
+        for name in self.superseded - set(self.master.values()):
+            try:
+                os.remove(os.path.join(self.out_dir, "mappings", name))
+            except FileNotFoundError:
+                pass
+            else:
+                log.info("Removed superseded mapping %s", name)
+        self.superseded.clear()
+
+
+def ingest(paths, workers=BULK_WORKERS, batch_size=BULK_BATCH, mongo=None, json_store=None):
+    stats = {"pdfs": len(paths), "stored": 0, "skipped": 0, "failed": 0, "collisions": 0,
+             "pages": 0, "linked": 0}
+    started = time.monotonic()
+    paths = unique_names(paths, stats)
+
+    def report(final=False):
+        elapsed = time.monotonic() - started
+        log.info("%s%d stored, %d skipped, %d failed, %d name collisions of %d PDFs; "
+                 "%d pages in %.1fs (%.1f pages/s)",
+                 "Done: " if final else "", stats["stored"], stats["skipped"], stats["failed"],
+                 stats["collisions"], stats["pdfs"], stats["pages"], elapsed, stats["pages"] / elapsed if elapsed else 0.0)
+
+    with ProcessPoolExecutor(workers) as pool:
+        by_sha = hash_files(pool, paths, stats)
+        todo = {}
+        for shas in batches(list(by_sha), LOOKUP_CHUNK):
+            found = mongo.existing(shas) if mongo else {}
+            known = []
+            for sha in shas:
+                paths_for = by_sha[sha]
+                if sha in found:
+                    known.append((paths_for, found[sha]))
+                    if json_store and not json_store.has(sha, paths_for):
+                        json_store.write(sha, paths_for, found[sha].get("topic_map", {}))
+                elif not mongo and json_store.has(sha, paths_for):
+                    known.append((paths_for, None))
+                else:
+                    todo[sha] = paths_for
+            stats["skipped"] += sum(len(p) for p, _ in known)
+            if mongo:
+                stats["linked"] += mongo.link(known)
+        if json_store:
+            json_store.save()
+        log.info("%d PDFs to parse (%d distinct contents)",
+                 sum(len(p) for p in todo.values()), len(todo))
+
+        if mongo:
+            mongo.clear_orphans(list(todo))
+        for batch in batches(iter_parsed(pool, todo, 2 * workers, stats), batch_size):
+            if mongo:
+                stats["linked"] += mongo.link(mongo.write(batch))
+            if json_store:
+                for sha, paths_for, parsed in batch:
+                    json_store.write(sha, paths_for, parsed["toc"]["topic_map"])
+                json_store.save()
+            stats["stored"] += sum(len(p) for _, p, _ in batch)
+            stats["pages"] += sum(len(parsed["page_texts"]) for _, _, parsed in batch)
+            report()
+
+    report(final=True)
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk-ingest PDFs into the PDF bot's store.")
+    parser.add_argument("source", help="directory of PDFs, or a manifest with one path per line")
+    parser.add_argument("--workers", type=int, default=BULK_WORKERS, help="parser processes")
+    parser.add_argument("--batch", type=int, default=BULK_BATCH, help="PDFs per bulk write")
+    parser.add_argument("--json-out", metavar="DIR",
+                        help="also write mappings/*.json and master_index.json under DIR")
+    parser.add_argument("--no-mongo", action="store_true", help="only write the JSON mappings")
+    args = parser.parse_args(argv)
+    if args.no_mongo and not args.json_out:
+        parser.error("--no-mongo needs --json-out")
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    mongo = None if args.no_mongo else MongoStore(pymongo.MongoClient(MONGO_URI)[DB_NAME])
+    json_store = JsonStore(args.json_out) if args.json_out else None
+    stats = ingest(list_pdfs(args.source), args.workers, args.batch, mongo, json_store)
+    return 1 if stats["failed"] or stats["collisions"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
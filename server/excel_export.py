@@ -0,0 +1,114 @@
+import io
+import csv
+import json
+import tempfile
+from openpyxl import Workbook
+
+XLSX_MIMETYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+# xlsx output stays in memory up to this size, then spills to a temp file
+SPOOL_MAX_BYTES = 16 * 1024 * 1024
+
+
+def iter_sheet_rows(sheet):
+    """
+    Yield (row_index, [values]) for one analyzer sheet in row order, with
+    only enabled cells and columns filled densely from 1 (gaps are None).
+    Rows may arrive unsorted or repeat an index; later cells win, like
+    repeated ws.cell() writes did.
+    """
+    ordered = sorted(sheet.get("rows", []), key=lambda r: _position(r, "row"))
+    i, n = 0, len(ordered)
+    while i < n:
+        index = ordered[i]["index"]
+        values = {}
+        while i < n and ordered[i]["index"] == index:
+            for cell in ordered[i].get("cells", []):
+                if cell.get("enable", False):
+                    values[_position(cell, "column")] = cell.get("value")
+            i += 1
+        if values:
+            yield index, [values.get(c) for c in range(1, max(values) + 1)]
+
+
+def _position(item, kind):
+    index = item.get("index")
+    if not isinstance(index, int) or index < 1:
+        raise ValueError(f"Invalid {kind} index: {index!r}")
+    return index
+
+
+def iter_dense_rows(sheet):
+    """Rows 1..n in order, empty lists standing in for missing indexes."""
+    expected = 1
+    for index, values in iter_sheet_rows(sheet):
+        while expected < index:
+            yield []
+            expected += 1
+        yield values
+        expected += 1
+
+
+def write_xlsx(data, fileobj):
+    """Write the analyzer payload with a write-only workbook, row by row."""
+    wb = Workbook(write_only=True)
+    for sheet in data.get("sheets", []):
+        ws = wb.create_sheet(title=sheet.get("name", "Sheet"))
+        for values in iter_dense_rows(sheet):
+            ws.append(values)
+    if not wb.sheetnames:
+        wb.create_sheet(title="Sheet")
+    # Activate sheet
+    active = data.get("activeSheet")
+    if active in wb.sheetnames:
+        wb.active = wb.sheetnames.index(active)
+    wb.save(fileobj)
+
+
+def xlsx_file(data):
+    """The xlsx in a spooled temp file, rewound and ready to stream."""
+    tmp = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    try:
+        write_xlsx(data, tmp)
+    except Exception:
+        tmp.close()
+        raise
+    tmp.seek(0)
+    return tmp
+
+
+def check_indexes(data):
+    """Raise ValueError up front, before a streamed response has started."""
+    for sheet in data.get("sheets", []):
+        for row in sheet.get("rows", []):
+            _position(row, "row")
+            for cell in row.get("cells", []):
+                if cell.get("enable", False):
+                    _position(cell, "column")
+
+
+def pick_sheet(data, name=None):
+    """The named sheet, else the active one, else the first."""
+    sheets = data.get("sheets", [])
+    for wanted in (name, data.get("activeSheet")):
+        for sheet in sheets:
+            if wanted is not None and sheet.get("name", "Sheet") == wanted:
+                return sheet
+    return sheets[0] if sheets else {"rows": []}
+
+
+def iter_csv(sheet):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for values in iter_dense_rows(sheet):
+        writer.writerow(["" if v is None else v for v in values])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+
+def iter_ndjson(data):
+    """One line per non-empty row: { sheet, index, values }."""
+    for sheet in data.get("sheets", []):
+        name = sheet.get("name", "Sheet")
+        for index, values in iter_sheet_rows(sheet):
+            yield json.dumps({"sheet": name, "index": index, "values": values}) + "\n"
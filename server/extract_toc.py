@@ -1,69 +1,149 @@
 import re
 import json
+from concurrent.futures import ProcessPoolExecutor
+import fitz  # PyMuPDF
 import pdfplumber
 from difflib import get_close_matches
 from PyPDF2 import PdfReader
 
+import rasa_shared  # noqa: F401
+from actions.page_ranges import merge_page_ranges
+
 
 def normalize(text):
     text = re.sub(r'\s+', ' ', text.lower())
     return re.sub(r'[^\w\s]', '', text).strip()
 
 
+TOC_LINE_PAT = re.compile(r"(?:\.{2,}\s*\d+$|\s{2,}\d+$)")
+
+
 def is_toc_like_page(text: str, min_entry_lines=3, min_total_lines=5) -> bool:
     if not text:
         return False
     lines = [ln.strip() for ln in text.splitlines() if ln.strip()]
     if len(lines) < min_total_lines:
         return False
-    toc_pat = re.compile(r"(?:\.{2,}\s*\d+$|\s{2,}\d+$)")
-    return sum(bool(toc_pat.search(ln)) for ln in lines) >= min_entry_lines
+    return sum(bool(TOC_LINE_PAT.search(ln)) for ln in lines) >= min_entry_lines
 
 
-def find_toc_page_range(pdf_path, max_scan_pages=50, min_toc_len=2):
+TOC_HEADING_PAT = re.compile(r"^(table of )?contents$")
+
+TOC_ENTRY_PAT = re.compile(
+    r"""
+    ^\s*
+    (.*?)                 # group1: title text
+    (?:\.{2,}\s*|\s{2,})   # dots-leader or ≥2 spaces
+    (\d{1,4})\s*$         # group2: page number
+    """,
+    re.VERBOSE
+)
+
+
+def toc_entries_from_text(txt):
+    for ln in txt.splitlines():
+        m = TOC_ENTRY_PAT.match(ln.strip())
+        if m:
+            yield m.group(1).strip(), int(m.group(2))
+
+
+def scan_toc(page_texts, max_scan_pages=50, min_toc_len=2):
+    """
+    Single pass over an iterable of page texts: detects the ToC page range
+    and collects its (title, page) entries from the same text, stopping at
+    the first page after the ToC block. Pass a lazy iterable so pages past
+    that point are never extracted.
+    Returns (toc_start, toc_end, entries), or (None, None, []) if no ToC.
+    """
     toc_start = toc_end = None
-    with pdfplumber.open(pdf_path) as pdf:
-        for i in range(min(len(pdf.pages), max_scan_pages)):
-            txt = pdf.pages[i].extract_text() or ""
+    entries = []
+    for i, txt in enumerate(page_texts):
+        if i >= max_scan_pages:
+            break
+        txt = txt or ""
+        if toc_start is None:
             low = [ln.strip().lower() for ln in txt.splitlines() if ln.strip()]
-            if toc_start is None:
-                print("the content:",low)
-                if any(re.match(r"^(table of )?contents$", ln) for ln in low):
-                    toc_start = toc_end = i + 1
-                elif is_toc_like_page(txt):
-                    toc_start = toc_end = i + 1
-            else:
-                if is_toc_like_page(txt):
-                    toc_end = i + 1
-                else:
-                    break
+            if not (any(TOC_HEADING_PAT.match(ln) for ln in low) or is_toc_like_page(txt)):
+                continue
+            toc_start = toc_end = i + 1
+        elif is_toc_like_page(txt):
+            toc_end = i + 1
+        else:
+            break
+        entries.extend(toc_entries_from_text(txt))
 
     if toc_start and toc_end and (toc_end - toc_start + 1) >= min_toc_len:
-        return toc_start, toc_end
-    return None, None
+        return toc_start, toc_end, entries
+    return None, None, []
 
 
-def extract_toc_entries(pdf_path, start_page, end_page):
-    pat = re.compile(
-        r"""
-        ^\s*
-        (.*?)                 # group1: title text
-        (?:\.{2,}\s*|\s{2,})   # dots-leader or ≥2 spaces
-        (\d{1,4})\s*$         # group2: page number
-        """,
-        re.VERBOSE
-    )
+def iter_page_texts(pdf):
+    for page in pdf.pages:
+        yield page.extract_text() or ""
+
+
+# --- ToC backends ---
+# Each takes (pdf_path, max_scan_pages, min_toc_len) and returns
+# (toc_start, toc_end, entries); empty entries means "not found here".
+
+def toc_from_outline(pdf_path, max_scan_pages=50, min_toc_len=2):
+    """
+    Embedded bookmark outline: no text extraction at all, and the page
+    numbers are real page indexes rather than printed labels.
+    """
+    with fitz.open(pdf_path) as doc:
+        outline = doc.get_toc(simple=True)   # [[level, title, page], ...]
+    entries = [(title.strip(), page) for _, title, page in outline
+               if page > 0 and title.strip()]
+    return None, None, entries
+
+
+def toc_from_pymupdf_text(pdf_path, max_scan_pages=50, min_toc_len=2):
+    with fitz.open(pdf_path) as doc:
+        return scan_toc((page.get_text() for page in doc), max_scan_pages, min_toc_len)
+
+
+def toc_from_pdfplumber(pdf_path, max_scan_pages=50, min_toc_len=2):
+    with pdfplumber.open(pdf_path) as pdf:
+        return scan_toc(iter_page_texts(pdf), max_scan_pages, min_toc_len)
+
+
+# Tried in order, cheapest first; pdfplumber is by far the slowest.
+TOC_BACKENDS = [
+    ("outline",    toc_from_outline),
+    ("pymupdf",    toc_from_pymupdf_text),
+    ("pdfplumber", toc_from_pdfplumber),
+]
+
 
+def extract_topic_map(pdf_path, backends=None, max_scan_pages=50, min_toc_len=2):
+    """
+    Build the topic_map with the first backend that finds a ToC.
+    Returns { topic_map, backend, toc_pages }; backend is None and
+    topic_map is {} if none of them did. toc_pages is [start, end]
+    for text-scanned ToCs and None for outlines.
+    """
+    for name, backend in (backends or TOC_BACKENDS):
+        toc_start, toc_end, entries = backend(pdf_path, max_scan_pages, min_toc_len)
+        if entries:
+            return {
+                "topic_map": build_topic_map(entries),
+                "backend": name,
+                "toc_pages": [toc_start, toc_end] if toc_start else None,
+            }
+    return {"topic_map": {}, "backend": None, "toc_pages": None}
+
+
+def find_toc_page_range(pdf_path, max_scan_pages=50, min_toc_len=2):
+    toc_start, toc_end, _ = toc_from_pdfplumber(pdf_path, max_scan_pages, min_toc_len)
+    return toc_start, toc_end
+
+
+def extract_toc_entries(pdf_path, start_page, end_page):
     entries = []
     with pdfplumber.open(pdf_path) as pdf:
         for p in range(start_page - 1, end_page):
-            txt = pdf.pages[p].extract_text() or ""
-            for ln in txt.splitlines():
-                m = pat.match(ln.strip())
-                if m:
-                    title = m.group(1).strip()
-                    page  = int(m.group(2))
-                    entries.append((title, page))
+            entries.extend(toc_entries_from_text(pdf.pages[p].extract_text() or ""))
     return entries
 
 
@@ -76,13 +156,70 @@ def build_topic_map(entries):
     return topic_map
 
 
-def extract_content(pdf_path, start, end):
+MAX_OUTPUT_CHARS   = 200_000  # text returned for one page query
+PARALLEL_MIN_PAGES = 64       # page sets this large are split across processes
+PAGES_PER_TASK     = 32
+
+
+def _extract_page_batch(pdf_path, pages):
     reader = PdfReader(pdf_path)
-    last = end or start
-    pages = []
-    for i in range(start - 1, last):
-        pages.append(reader.pages[i].extract_text() or "")
-    return "\n".join(pages).strip()
+    return [reader.pages[p - 1].extract_text() or "" for p in pages]
+
+
+def iter_page_contents(pdf_path, pages, workers=None):
+    """
+    Text of the given 1-based pages, in order. Small sets are read with one
+    PdfReader; large ones are split into batches across a process pool.
+    Batches not yet started are cancelled when the caller stops early.
+    """
+    if len(pages) < PARALLEL_MIN_PAGES or workers == 1:
+        reader = PdfReader(pdf_path)
+        for p in pages:
+            yield reader.pages[p - 1].extract_text() or ""
+        return
+
+    batches = [pages[i:i + PAGES_PER_TASK] for i in range(0, len(pages), PAGES_PER_TASK)]
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(_extract_page_batch, pdf_path, b) for b in batches]
+        try:
+            for fut in futures:
+                yield from fut.result()
+        finally:
+            for fut in futures:
+                fut.cancel()
+
+
+def extract_ranges(pdf_path, ranges, max_chars=MAX_OUTPUT_CHARS, workers=None):
+    """
+    Text for several page ranges, opened once: ranges are merged first and
+    the pages read in order until `max_chars` of text is collected
+    (None for no limit). Returns ([(start, end, text)], truncated).
+    """
+    ranges = merge_page_ranges(ranges)
+    texts = iter_page_contents(pdf_path, [p for s, e in ranges for p in range(s, e + 1)], workers)
+    parts, budget = [], max_chars
+    try:
+        for s, e in ranges:
+            chunk = []
+            for _ in range(s, e + 1):
+                text = next(texts)
+                if budget is not None:
+                    text = text[:budget]
+                    budget -= len(text)
+                chunk.append(text)
+                if budget is not None and budget <= 0:
+                    break
+            parts.append((s, e, "\n".join(chunk).strip()))
+            if budget is not None and budget <= 0:
+                return parts, True
+    finally:
+        texts.close()
+    return parts, False
+
+
+def extract_content(pdf_path, start, end):
+    parts, _ = extract_ranges(pdf_path, [(start, end or start)], max_chars=None)
+    return parts[0][2]
 
 def topic_search():
     query = input("🔎 Enter topic to extract: ").strip()
@@ -113,34 +250,28 @@ def parse_page_input(input_str):
             ranges.append((val, val))
     return ranges
 
-def extract_from_page_query(pdf_path, page_input):
+def extract_from_page_query(pdf_path, page_input, max_chars=MAX_OUTPUT_CHARS):
     page_ranges = parse_page_input(page_input)
+    parts, truncated = extract_ranges(pdf_path, page_ranges, max_chars)
     all_content = []
-    for start, end in page_ranges:
-        content = extract_content(pdf_path, start, end)
+    for start, end, content in parts:
         if content:
             all_content.append(f"\n--- Page {start} to {end} ---\n{content}")
+    if truncated:
+        all_content.append(f"\n[output truncated at {max_chars} characters]")
     return "\n".join(all_content).strip()
 
 
 if __name__ == "__main__":
     pdf_path = r"c:\Users\Akil\Downloads\lnotes_book.pdf"
 
-    # 1) detect ToC pages
-    start, end = find_toc_page_range(pdf_path)
-    if not start:
+    # 1) detect the ToC and build the topic_map
+    toc = extract_topic_map(pdf_path)
+    topic_map = toc["topic_map"]
+    if not topic_map:
         print("TOC not detected.")
         exit(1)
-    print(f"✅ TOC pages: {start}–{end}")
-
-    # 2) extract TOC entries
-    raw_entries = extract_toc_entries(pdf_path, start, end)
-    if not raw_entries:
-        print("❌ No ToC entries found.")
-        exit(1)
-
-    # 3) build raw topic_map
-    topic_map = build_topic_map(raw_entries)
+    print(f"✅ TOC from {toc['backend']}" + (f", pages {toc['toc_pages'][0]}–{toc['toc_pages'][1]}" if toc["toc_pages"] else ""))
 
     # 6) save JSON
     with open("topic_map.json", "w", encoding="utf-8") as f:
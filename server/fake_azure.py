@@ -0,0 +1,144 @@
+# server/fake_azure.py
+"""
+Local stand-in for Azure OpenAI chat completions and Form Recognizer
+prebuilt-layout, for load-testing the throttling in azure_limits.py.
+Injects 429s with Retry-After and latency:
+
+    FAKE_AZURE_429_RATE=0.3 FAKE_AZURE_LATENCY_MS=400 python fake_azure.py
+    AZURE_ENDPOINT=http://localhost:5002 DOC_INTEL_ENDPOINT=http://localhost:5002 python app.py
+
+GET /_stats reports what it served.
+"""
+import io
+import os
+import json
+import time
+import uuid
+import random
+import threading
+from flask import Flask, request, jsonify
+from PyPDF2 import PdfReader
+
+FAKE_AZURE_429_RATE   = float(os.getenv("FAKE_AZURE_429_RATE", 0.2))   # share of calls throttled
+FAKE_AZURE_RETRY_AFTER = float(os.getenv("FAKE_AZURE_RETRY_AFTER", 1))  # seconds, sent with 429s
+FAKE_AZURE_LATENCY_MS = float(os.getenv("FAKE_AZURE_LATENCY_MS", 200))  # mean, exponential
+FAKE_AZURE_MAX_CONCURRENT = int(os.getenv("FAKE_AZURE_MAX_CONCURRENT", 0))  # 429 above this; 0 = no cap
+
+app = Flask(__name__)
+
+_lock = threading.Lock()
+_stats = {"requests": 0, "throttled": 0, "in_flight": 0, "max_in_flight": 0}
+_operations = {}   # operation id -> analyzeResult
+
+
+def throttled():
+    """A 429 response when this call is chosen to be throttled, else None."""
+    with _lock:
+        _stats["requests"] += 1
+        over_cap = FAKE_AZURE_MAX_CONCURRENT and _stats["in_flight"] >= FAKE_AZURE_MAX_CONCURRENT
+        if over_cap or random.random() < FAKE_AZURE_429_RATE:
+            _stats["throttled"] += 1
+            resp = jsonify({"error": {"code": "429", "message": "Rate limit is exceeded."}})
+            resp.status_code = 429
+            resp.headers["Retry-After"] = f"{FAKE_AZURE_RETRY_AFTER:g}"
+            return resp
+        _stats["in_flight"] += 1
+        _stats["max_in_flight"] = max(_stats["max_in_flight"], _stats["in_flight"])
+    return None
+
+
+def served():
+    with _lock:
+        _stats["in_flight"] -= 1
+
+
+def latency():
+    if FAKE_AZURE_LATENCY_MS:
+        time.sleep(random.expovariate(1000.0 / FAKE_AZURE_LATENCY_MS))
+
+
+@app.route("/openai/deployments/<deployment>/chat/completions", methods=["POST"])
+def chat_completions(deployment):
+    busy = throttled()
+    if busy:
+        return busy
+    try:
+        latency()
+        chart = {"title": "Fake chart", "axes": {"x": "Month", "y": "Sales"},
+                 "data_points": [{"label": m, "value": random.randint(1, 100)}
+                                 for m in ("Jan", "Feb", "Mar")]}
+        return jsonify({
+            "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+            "object": "chat.completion",
+            "model": deployment,
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": json.dumps(chart)}}],
+            "usage": {"prompt_tokens": 800, "completion_tokens": 60, "total_tokens": 860},
+        })
+    finally:
+        served()
+
+
+def fake_layout(page_count):
+    """A prebuilt-layout analyzeResult: one text line and one 2x2 table per page."""
+    pages, tables = [], []
+    for n in range(1, page_count + 1):
+        pages.append({
+            "pageNumber": n, "angle": 0, "width": 8.5, "height": 11, "unit": "inch",
+            "spans": [], "words": [],
+            "lines": [{"content": f"Page {n} heading",
+                       "polygon": [1, 1, 4, 1, 4, 1.3, 1, 1.3], "spans": []}],
+        })
+        tables.append({
+            "rowCount": 2, "columnCount": 2, "spans": [],
+            "boundingRegions": [{"pageNumber": n, "polygon": [1, 2, 7, 2, 7, 4, 1, 4]}],
+            "cells": [{"rowIndex": r, "columnIndex": c, "content": f"p{n} r{r} c{c}", "spans": []}
+                      for r in range(2) for c in range(2)],
+        })
+    return {"apiVersion": request.args.get("api-version", ""), "modelId": "prebuilt-layout",
+            "stringIndexType": "textElements", "content": "", "pages": pages, "tables": tables}
+
+
+@app.route("/formrecognizer/documentModels/<model>:analyze", methods=["POST"])
+def analyze_document(model):
+    busy = throttled()
+    if busy:
+        return busy
+    try:
+        latency()
+        try:
+            page_count = len(PdfReader(io.BytesIO(request.get_data())).pages)
+        except Exception:
+            page_count = 1
+        op_id = uuid.uuid4().hex
+        with _lock:
+            _operations[op_id] = fake_layout(page_count)
+        resp = jsonify({})
+        resp.status_code = 202
+        resp.headers["Operation-Location"] = (
+            f"{request.host_url.rstrip('/')}/formrecognizer/documentModels/{model}"
+            f"/analyzeResults/{op_id}?api-version={request.args.get('api-version', '')}")
+        return resp
+    finally:
+        served()
+
+
+@app.route("/formrecognizer/documentModels/<model>/analyzeResults/<op_id>", methods=["GET"])
+def analyze_result(model, op_id):
+    with _lock:
+        result = _operations.get(op_id)
+    if result is None:
+        return jsonify({"error": {"code": "NotFound", "message": "Unknown operation"}}), 404
+    now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    return jsonify({"status": "succeeded", "createdDateTime": now,
+                    "lastUpdatedDateTime": now, "analyzeResult": result})
+
+
+@app.route("/_stats", methods=["GET"])
+def stats():
+    with _lock:
+        return jsonify(dict(_stats))
+
+
+if __name__ == "__main__":
+    app.run(port=int(os.getenv("FAKE_AZURE_PORT", 5002)), threaded=True)
@@ -1,31 +1,232 @@
 import os
+import re
+import time
+import io
 import base64
+import hashlib
 import tempfile
 import json
 import logging
+import datetime
+import threading
+from collections import OrderedDict
 import requests
+from requests.adapters import HTTPAdapter
 from flask import Flask, request, jsonify
 from werkzeug.utils import secure_filename
 from flask_cors import CORS
 import pymongo
+from azure_limits import get_throttle
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # images are then sent as uploaded
+    Image = ImageOps = None
 # Azure API credentials (replace with your actual keys)
 AZURE_API_KEY = os.getenv("AZURE_API_KEY")
 AZURE_ENDPOINT = os.getenv("AZURE_ENDPOINT")
 AZURE_DEPLOYMENT = os.getenv("AZURE_DEPLOYMENT")
+AZURE_API_VERSION = "2023-12-01-preview"
+# Keep-alive connections to Azure shared by all concurrent chart calls
+AZURE_HTTP_POOL = int(os.getenv("AZURE_HTTP_POOL", 16))
+# Client-side limits for the deployment (see azure_limits.py)
+AZURE_OPENAI_RPS   = float(os.getenv("AZURE_OPENAI_RPS", 5))
+AZURE_OPENAI_BURST = int(os.getenv("AZURE_OPENAI_BURST", 10))
+
+# Images larger than this on their longest side are downscaled before the
+# Azure call (0 sends them as uploaded); needs Pillow
+CHART_MAX_DIM      = int(os.getenv("CHART_MAX_DIM", 2048))
+CHART_JPEG_QUALITY = int(os.getenv("CHART_JPEG_QUALITY", 85))
+
+CHART_PROMPT = "Extract data from this chart as JSON. Include: title, axes labels, data points (value, label). Return ONLY valid JSON."
+
+# Result cache: identical image + prompt + deployment skips the Azure call
+CHART_CACHE_TTL  = int(os.getenv("CHART_CACHE_TTL", 7 * 24 * 3600))   # seconds
+CHART_CACHE_SIZE = int(os.getenv("CHART_CACHE_SIZE", 256))            # in-memory entries
 
 # MongoDB Config
 MONGO_URI = os.getenv("MONGO_URI")
 DB_NAME = os.getenv("DB_NAME", "pdf_bot")
 
+log = logging.getLogger(__name__)
+
 # Initialize clients
 mongo = pymongo.MongoClient(MONGO_URI)
 db = mongo[DB_NAME]
 graph_coll = db["graph_analysis"]
+cache_coll = db["graph_cache"]     # { _id: cache key, result, created_at }
+cache_coll.create_index("created_at", expireAfterSeconds=CHART_CACHE_TTL)
+
+
+class ChartResultCache:
+    """
+    Two-tier cache of Azure chart analyses: a small in-process LRU in front
+    of a Mongo collection shared by all workers. Both tiers honour the TTL.
+    """
+
+    def __init__(self, coll, max_entries, ttl):
+        self.coll        = coll
+        self.max_entries = max_entries
+        self.ttl         = ttl
+        self._mem        = OrderedDict()   # key -> (expires_at, result)
+        self._lock       = threading.Lock()
+
+    @staticmethod
+    def key_for(image_bytes):
+        h = hashlib.sha256(image_bytes)
+        # what is sent depends on the downscale settings as well
+        downscale = f"{CHART_MAX_DIM}:{CHART_JPEG_QUALITY}:upright" if Image is not None else ""
+        # deployment names are only unique within one resource, hence the endpoint
+        for part in (CHART_PROMPT, (AZURE_ENDPOINT or "").rstrip("/").lower(),
+                     AZURE_DEPLOYMENT or "", AZURE_API_VERSION, downscale):
+            h.update(b"\0" + part.encode("utf-8"))
+        return h.hexdigest()
+
+    def get(self, key):
+        hit = self.recall(key)
+        if hit is not None:
+            return hit
+        return self._remember_doc(key, self.coll.find_one(self._fresh(key)))
+
+    def put(self, key, result):
+        self.coll.replace_one({"_id": key}, self._doc(key, result), upsert=True)
+        self._remember(key, result, time.time() + self.ttl)
+
+    def recall(self, key):
+        """The in-process entry for `key`, if any and not expired."""
+        with self._lock:
+            hit = self._mem.get(key)
+            if hit and hit[0] > time.time():
+                self._mem.move_to_end(key)
+                return hit[1]
+            self._mem.pop(key, None)
+        return None
+
+    def _fresh(self, key):
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.ttl)
+        return {"_id": key, "created_at": {"$gt": cutoff}}
+
+    @staticmethod
+    def _doc(key, result):
+        return {"_id": key, "result": result, "created_at": datetime.datetime.utcnow()}
+
+    def _remember_doc(self, key, doc):
+        if not doc:
+            return None
+        remaining = self.ttl - (datetime.datetime.utcnow() - doc["created_at"]).total_seconds()
+        self._remember(key, doc["result"], time.time() + remaining)
+        return doc["result"]
+
+    def _remember(self, key, result, expires_at):
+        with self._lock:
+            self._mem[key] = (expires_at, result)
+            self._mem.move_to_end(key)
+            while len(self._mem) > self.max_entries:
+                self._mem.popitem(last=False)
+
+
+chart_cache = ChartResultCache(cache_coll, CHART_CACHE_SIZE, CHART_CACHE_TTL)
+
+openai_throttle = get_throttle("azure_openai", AZURE_OPENAI_RPS, AZURE_OPENAI_BURST, AZURE_HTTP_POOL)
+
+http = requests.Session()
+http.mount("https://", HTTPAdapter(pool_maxsize=AZURE_HTTP_POOL))
+http.mount("http://", HTTPAdapter(pool_maxsize=AZURE_HTTP_POOL))
+
+
+def image_mime(image_bytes):
+    if image_bytes.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if image_bytes[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if image_bytes[:4] == b"RIFF" and image_bytes[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/jpeg"
+
+
+def prepare_image(image_bytes):
+    """
+    The image as it goes to Azure: turned upright per its EXIF orientation
+    and downscaled to CHART_MAX_DIM on its longest side when Pillow is
+    installed and the image is bigger, as PNG if it has transparency and
+    JPEG otherwise. Kept as uploaded when that would not make it smaller.
+    Returns (bytes, mime type).
+    """
+    mime = image_mime(image_bytes)
+    if Image is None or not CHART_MAX_DIM:
+        return image_bytes, mime
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            if max(img.size) <= CHART_MAX_DIM:
+                return image_bytes, mime
+            # re-encoding drops the EXIF Orientation tag, so apply it first
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((CHART_MAX_DIM, CHART_MAX_DIM), Image.LANCZOS)
+            out = io.BytesIO()
+            if img.mode in ("RGBA", "LA") or "transparency" in img.info:
+                img.save(out, "PNG", optimize=True)
+                new_mime = "image/png"
+            else:
+                img.convert("RGB").save(out, "JPEG", quality=CHART_JPEG_QUALITY, optimize=True)
+                new_mime = "image/jpeg"
+    except Exception:
+        log.warning("Could not downscale image; sending it as uploaded", exc_info=True)
+        return image_bytes, mime
+    if out.tell() >= len(image_bytes):
+        return image_bytes, mime
+    return out.getvalue(), new_mime
+
 
 # Function to send image to Azure OpenAI Vision
 def analyze_chart(image_path):
     with open(image_path, "rb") as f:
-        base64_image = base64.b64encode(f.read()).decode("utf-8")
+        return analyze_chart_bytes(f.read())
+
+
+def analyze_chart_bytes(image_bytes):
+    return analyze_chart_image(image_bytes)[0]
+
+
+def analyze_chart_image(image_bytes):
+    """
+    Azure analysis of an in-memory image. Returns (result, image stats):
+    the stats give the MIME type and byte counts of what was sent, or
+    just `cached` when the result came from the chart cache.
+    """
+    cache_key = ChartResultCache.key_for(image_bytes)
+    cached = chart_cache.get(cache_key)
+    if cached is not None:
+        return cached, {"cached": True, "original_bytes": len(image_bytes)}
+
+    url, headers, payload, stats = chart_request(image_bytes)
+    response = openai_throttle.call(post_checked, url, headers=headers, json=payload)
+    result = response.json()
+
+    # Insert into MongoDB (a copy, so the cached result carries no ObjectId)
+    graph_coll.insert_one(dict(result))
+    chart_cache.put(cache_key, result)
+
+    return result, stats
+
+
+def post_checked(url, **kwargs):
+    response = http.post(url, **kwargs)
+    response.raise_for_status()
+    return response
+
+
+def chart_request(image_bytes):
+    """(url, headers, json payload, image stats) of the Azure call for an image."""
+    sent_bytes, mime = prepare_image(image_bytes)
+    stats = {
+        "cached": False,
+        "mime": mime,
+        "original_bytes": len(image_bytes),
+        "sent_bytes": len(sent_bytes),
+        "bytes_saved": len(image_bytes) - len(sent_bytes),
+    }
+    if stats["bytes_saved"]:
+        log.info("Chart image downscaled: %d -> %d bytes", len(image_bytes), len(sent_bytes))
+    base64_image = base64.b64encode(sent_bytes).decode("utf-8")
 
     headers = {
         "Content-Type": "application/json",
@@ -38,12 +239,12 @@ def analyze_chart(image_path):
                 "content": [
                     {
                         "type": "text",
-                        "text": "Extract data from this chart as JSON. Include: title, axes labels, data points (value, label). Return ONLY valid JSON."
+                        "text": CHART_PROMPT
                     },
                     {
                         "type": "image_url",
                         "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}"
+                            "url": f"data:{mime};base64,{base64_image}"
                         }
                     }
                 ]
@@ -53,16 +254,35 @@ def analyze_chart(image_path):
         "temperature": 0,
         "stop":"None"
     }
+    url = f"{AZURE_ENDPOINT}/openai/deployments/{AZURE_DEPLOYMENT}/chat/completions?api-version={AZURE_API_VERSION}"
+    return url, headers, payload, stats
 
-    response = requests.post(
-        f"{AZURE_ENDPOINT}/openai/deployments/{AZURE_DEPLOYMENT}/chat/completions?api-version=2023-12-01-preview",
-        headers=headers,
-        json=payload
-    )
-    response.raise_for_status()
-    result = response.json()
 
-    # Insert into MongoDB
-    graph_coll.insert_one(result)
+def chart_payload(result, image_stats=None):
+    """Turn an Azure chat completion into the /upload_graph response body."""
+    raw_content = result["choices"][0]["message"]["content"]
+    log.info("Azure raw response:\n%s", raw_content)
+
+    json_str = re.sub(r"```json|```", "", raw_content).strip()
+    data = json.loads(json_str)
+
+    raw_pts = data.get("data_points") or data.get("dataPoints") or []
+    if isinstance(raw_pts, list):
+        flat_points = raw_pts
+    elif isinstance(raw_pts, dict):
+        flat_points = [{"label": k, "value": v} for k, v in raw_pts.items()]
+    else:
+        flat_points = []
 
-    return result
+    payload = {
+        "ok": True,
+        "raw": data,  # full original parsed content
+        "title": data.get("title"),
+        "x_axis_label": data.get("x_axis_label") or data.get("axes", {}).get("x"),
+        "y_axis_label": data.get("y_axis_label") or data.get("axes", {}).get("y"),
+        "data": data.get("data", []),
+        "dataPoints": flat_points
+    }
+    if image_stats is not None:
+        payload["image"] = image_stats
+    return payload
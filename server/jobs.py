@@ -0,0 +1,108 @@
+import os
+import uuid
+import logging
+import threading
+import datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+log = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class InlineJob:
+    """Job context for work done directly on the request thread."""
+
+    def progress(self, stage):
+        pass
+
+    def run_cpu(self, fn, *args):
+        return fn(*args)
+
+
+class _QueuedJob:
+    def __init__(self, queue, job_id):
+        self.queue  = queue
+        self.job_id = job_id
+
+    def progress(self, stage):
+        self.queue._update(self.job_id, progress=stage)
+
+    def run_cpu(self, fn, *args):
+        """Run CPU-bound work (PDF parsing) in the process pool and wait for it."""
+        return self.queue.cpu_pool.submit(fn, *args).result()
+
+
+class JobQueue:
+    """
+    Background jobs with their state in a Mongo collection:
+    { _id, kind, status, progress, result, error, created_at, updated_at }.
+    Jobs run on a bounded thread pool, which suits the Azure I/O waits. A
+    job hands PDF parsing to the process pool via `job.run_cpu`. At most
+    `max_pending` jobs may be queued or running; beyond that `submit`
+    raises QueueFull. Jobs still queued or running when the queue is
+    created (left by a previous process) are marked failed.
+    """
+
+    def __init__(self, coll, io_workers=8, cpu_workers=None, max_pending=64, ttl_hours=24):
+        self.coll     = coll
+        self.io_pool  = ThreadPoolExecutor(io_workers, thread_name_prefix="job")
+        self.cpu_pool = ProcessPoolExecutor(cpu_workers or os.cpu_count())
+        self._slots   = threading.BoundedSemaphore(max_pending)
+        # finished jobs expire on their own
+        coll.create_index("updated_at", expireAfterSeconds=ttl_hours * 3600)
+        self._fail_interrupted()
+
+    def _fail_interrupted(self):
+        """
+        Jobs a previous process left queued or running can no longer finish;
+        mark them failed rather than have /jobs/<id> report them as running
+        until they expire.
+        """
+        res = self.coll.update_many(
+            {"status": {"$in": ["queued", "running"]}},
+            {"$set": {"status": "failed", "progress": None,
+                      "error": "interrupted by a server restart",
+                      "updated_at": datetime.datetime.utcnow()}})
+        if res.modified_count:
+            log.warning("Marked %d interrupted jobs as failed", res.modified_count)
+
+    def submit(self, kind, fn, *args) -> str:
+        """
+        Queue `fn(job, *args)` and return the job id. `fn` returns the
+        JSON-serialisable result that /jobs/<id> reports once done.
+        """
+        if not self._slots.acquire(blocking=False):
+            raise QueueFull(f"{kind}: too many jobs in progress")
+        job_id = uuid.uuid4().hex
+        now = datetime.datetime.utcnow()
+        try:
+            self.coll.insert_one({
+                "_id": job_id, "kind": kind, "status": "queued", "progress": None,
+                "created_at": now, "updated_at": now
+            })
+            self.io_pool.submit(self._run, job_id, fn, args)
+        except BaseException:
+            self._slots.release()   # _run never started, so it cannot release it
+            raise
+        return job_id
+
+    def get(self, job_id):
+        return self.coll.find_one({"_id": job_id})
+
+    def _run(self, job_id, fn, args):
+        try:
+            self._update(job_id, status="running")
+            result = fn(_QueuedJob(self, job_id), *args)
+            self._update(job_id, status="done", progress=None, result=result)
+        except Exception as e:
+            log.exception("Job %s failed", job_id)
+            self._update(job_id, status="failed", error=str(e))
+        finally:
+            self._slots.release()
+
+    def _update(self, job_id, **fields):
+        fields["updated_at"] = datetime.datetime.utcnow()
+        self.coll.update_one({"_id": job_id}, {"$set": fields})
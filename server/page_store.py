@@ -0,0 +1,33 @@
+import fitz  # PyMuPDF
+
+
+def extract_page_texts(pdf_path):
+    """
+    Extract the text of every page once, in page order. Uses the same
+    PyMuPDF extraction the Rasa action used to run per message, so the
+    stored text is identical to what it used to produce.
+    """
+    with fitz.open(pdf_path) as doc:
+        return [page.get_text() for page in doc]
+
+
+def ensure_page_indexes(pages):
+    """One document per page, addressed by (mapping_id, page)."""
+    pages.create_index([("mapping_id", 1), ("page", 1)], unique=True)
+
+
+def page_documents(mapping_id, texts):
+    """{ mapping_id, page, text } documents (page numbers are 1-based, like the ones users ask for)."""
+    return [{"mapping_id": mapping_id, "page": i + 1, "text": text}
+            for i, text in enumerate(texts)]
+
+
+def store_pages(pages, mapping_id, texts):
+    """Persist page texts as page_documents."""
+    if not texts:
+        return
+    pages.insert_many(page_documents(mapping_id, texts), ordered=False)
+
+
+def delete_pages(pages, mapping_id):
+    pages.delete_many({"mapping_id": mapping_id})
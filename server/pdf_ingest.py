@@ -0,0 +1,36 @@
+from extract_toc import extract_topic_map
+from page_store import extract_page_texts
+from text_search import build_search_index
+from topic_index import build_topic_index, build_section_index
+
+
+def parse_pdf(pdf_path):
+    """
+    CPU-bound part of a PDF upload: ToC detection, page text extraction
+    and the full-text search index. Touches nothing but the file, so it
+    can run in a worker process.
+    """
+    page_texts = extract_page_texts(pdf_path)
+    search_stats, postings = build_search_index(page_texts)
+    return {
+        "toc": extract_topic_map(pdf_path),
+        "page_texts": page_texts,
+        "search_stats": search_stats,
+        "postings": postings,
+    }
+
+
+def mapping_document(mapping_id, sha256, file_id, parsed):
+    """The `mappings` document for a parsed PDF stored as GridFS `file_id`."""
+    topic_map = parsed["toc"]["topic_map"]
+    return {
+        "_id": mapping_id,
+        "sha256": sha256,
+        "file_id": file_id,
+        "topic_map": topic_map,
+        "topic_index": build_topic_index(topic_map),
+        "section_index": build_section_index(topic_map),
+        "toc_backend": parsed["toc"]["backend"],
+        "page_count": len(parsed["page_texts"]),
+        "search_stats": parsed["search_stats"]
+    }
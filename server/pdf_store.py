@@ -0,0 +1,108 @@
+import datetime
+import logging
+import threading
+from pymongo import ReturnDocument
+
+from page_store import delete_pages
+from text_search import delete_search_index
+
+log = logging.getLogger(__name__)
+
+
+def ensure_store_indexes(maps, idx):
+    """One mapping per PDF content; legacy mappings carry no sha256."""
+    maps.create_index("sha256", unique=True,
+                      partialFilterExpression={"sha256": {"$type": "string"}})
+    maps.create_index("released_at", sparse=True)
+    idx.create_index("mapping_id")
+
+
+def ensure_library_indexes(changes, ttl_days):
+    changes.create_index("created_at", expireAfterSeconds=int(ttl_days * 24 * 3600))
+
+
+def record_library_change(meta, changes, filename, mapping_id):
+    """
+    Bump the library version and log which mapping `filename` now points
+    at, so readers can apply uploads one by one instead of reloading.
+    Change _ids are the versions; readers apply them in order and reload
+    everything when the next one they need has expired.
+    """
+    version = meta.find_one_and_update(
+        {"_id": "library"}, {"$inc": {"version": 1}},
+        upsert=True, return_document=ReturnDocument.AFTER
+    )["version"]
+    changes.insert_one({"_id": version, "filename": filename, "mapping_id": mapping_id,
+                        "created_at": datetime.datetime.utcnow()})
+    return version
+
+
+def claim_mapping(maps, sha256):
+    """
+    The mapping already built for this content, if any, taken back from
+    the garbage collector. None when the content is new or the mapping
+    was collected in the meantime.
+    """
+    return maps.find_one_and_update(
+        {"sha256": sha256},
+        {"$unset": {"released_at": ""}},
+        projection={"sha256": 1, "file_id": 1, "topic_map": 1, "toc_backend": 1}
+    )
+
+
+def release_mapping(maps, idx, mapping_id):
+    """Hand a mapping to the collector once no filename points at it."""
+    if mapping_id is None or idx.find_one({"mapping_id": mapping_id}, {"_id": 1}):
+        return
+    maps.update_one({"_id": mapping_id, "released_at": {"$exists": False}},
+                    {"$set": {"released_at": datetime.datetime.utcnow()}})
+
+
+def collect_garbage(maps, idx, pages, postings, fs, grace):
+    """
+    Delete mappings released longer than `grace` ago together with their
+    pages, search postings and GridFS blob. A mapping claimed again in the
+    meantime has lost its released_at and is left alone. Returns the
+    number of mappings removed.
+    """
+    cutoff = datetime.datetime.utcnow() - grace
+    removed = 0
+    for doc in maps.find({"released_at": {"$lt": cutoff}}, {"file_id": 1}):
+        if idx.find_one({"mapping_id": doc["_id"]}, {"_id": 1}):
+            maps.update_one({"_id": doc["_id"]}, {"$unset": {"released_at": ""}})
+            continue
+        if not maps.delete_one({"_id": doc["_id"], "released_at": {"$lt": cutoff}}).deleted_count:
+            continue
+        delete_pages(pages, doc["_id"])
+        delete_search_index(postings, doc["_id"])
+        if doc.get("file_id") is not None:
+            fs.delete(doc["file_id"])
+        removed += 1
+    return removed
+
+
+class GarbageCollector:
+    """Runs collect_garbage every `interval` seconds on a daemon thread."""
+
+    def __init__(self, maps, idx, pages, postings, fs, grace_hours, interval):
+        self.colls = (maps, idx, pages, postings, fs)
+        self.grace = datetime.timedelta(hours=grace_hours)
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="pdf-gc", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                removed = collect_garbage(*self.colls, self.grace)
+                if removed:
+                    log.info("Collected %d unreferenced mappings", removed)
+            except Exception:
+                log.exception("PDF garbage collection failed")
@@ -0,0 +1,15 @@
+# rasa_shared.py
+"""
+Puts rasa_backend on sys.path, so server modules can import the helpers
+they share with the action server from their one implementation in the
+`actions` package (actions.topic_index, actions.page_ranges):
+
+    import rasa_shared  # noqa: F401
+    from actions.page_ranges import merge_page_ranges
+"""
+import os
+import sys
+
+RASA_BACKEND = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "rasa_backend")
+if RASA_BACKEND not in sys.path:
+    sys.path.append(RASA_BACKEND)
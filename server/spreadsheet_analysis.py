@@ -1,14 +1,37 @@
 import io
 import os
 import json
+import hashlib
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import pymongo
+from pymongo import ReplaceOne
+from PyPDF2 import PdfReader, PdfWriter
+from PyPDF2.generic import ArrayObject
 from azure.ai.formrecognizer import DocumentAnalysisClient
 from azure.core.credentials import AzureKeyCredential
 from shapely.geometry import Polygon, Point
+from shapely.strtree import STRtree
+from azure_limits import get_throttle
+
+log = logging.getLogger(__name__)
 
 # Azure AI Document Intelligence credentials
 DOC_INTEL_ENDPOINT = os.getenv("DOC_INTEL_ENDPOINT")
 DOC_INTEL_KEY = os.getenv("DOC_INTEL_KEY")
+LAYOUT_MODEL = "prebuilt-layout"
+# Bump when the stored per-page layout format changes
+LAYOUT_CACHE_VERSION = "1"
+# Bump when banding or merging (sheet_data, merge_pages) changes the stored result
+SHEET_MERGE_VERSION = "1"
+# Pages per Azure call; 0 (default) sends the whole document at once. Tables
+# crossing a window boundary come back as two tables, so this is opt-in.
+LAYOUT_WINDOW_PAGES  = int(os.getenv("LAYOUT_WINDOW_PAGES", 0))
+LAYOUT_MAX_IN_FLIGHT = int(os.getenv("LAYOUT_MAX_IN_FLIGHT", 4))  # concurrent pollers per document
+# Client-side limits for the resource, across documents (see azure_limits.py)
+DOC_INTEL_RPS             = float(os.getenv("DOC_INTEL_RPS", 15))
+DOC_INTEL_MAX_CONCURRENCY = int(os.getenv("DOC_INTEL_MAX_CONCURRENCY", 16))
 
 # MongoDB connection (falls back to localhost)
 MONGO_URI = os.getenv("MONGO_URI")
@@ -21,94 +44,365 @@ doc_client = DocumentAnalysisClient(
 )
 mongo = pymongo.MongoClient(MONGO_URI)
 db = mongo[DB_NAME]
-coll = db["spreadsheet_analysis"]
+coll = db["spreadsheet_analysis"]       # { filename, merged, sha256, version, data }
+page_coll = db["spreadsheet_pages"]     # { _id: page hash, layout }
+coll.create_index("sha256")
+layout_throttle = get_throttle("form_recognizer", DOC_INTEL_RPS, max(1, int(DOC_INTEL_RPS)),
+                               DOC_INTEL_MAX_CONCURRENCY)
+
+# Stored with each merged result; a result of another version is re-derived.
+# Windowing changes where tables split, so the window size is part of it.
+RESULT_VERSION = f"{LAYOUT_MODEL}:{LAYOUT_CACHE_VERSION}:{SHEET_MERGE_VERSION}:{LAYOUT_WINDOW_PAGES}"
+
+
+def cached_result_filter(pdf_hash: str) -> dict:
+    return {"sha256": pdf_hash, "version": RESULT_VERSION}
+
 
+def result_document(file_name: str, pdf_hash: str, data: dict) -> dict:
+    return {"filename": file_name, "merged": True, "sha256": pdf_hash,
+            "version": RESULT_VERSION, "data": data}
 
-def analyze_spreadsheet_auto_merge(pdf_bytes: bytes, file_name: str) -> dict:
+
+def analyze_spreadsheet_auto_merge(pdf_bytes: bytes, file_name: str, client=None) -> dict:
     """
     Analyze a PDF via Azure prebuilt-layout, automatically merging tables
     horizontally or vertically based on layout, interleaving non-table text,
-    stores { filename, merged: True, data } in MongoDB, and returns the JSON.
+    stores { filename, merged: True, sha256, version, data } in MongoDB, and returns the JSON.
+    A PDF analyzed before under the same RESULT_VERSION is answered from
+    MongoDB; otherwise only pages whose layout is not cached yet are sent
+    to Azure, through `client` (a DocumentAnalysisClient, `doc_client` by
+    default).
     """
-    # Run Form Recognizer
-    stream = io.BytesIO(pdf_bytes)
-    poller = doc_client.begin_analyze_document("prebuilt-layout", document=stream)
-    result = poller.result()
+    pdf_hash = hashlib.sha256(pdf_bytes).hexdigest()
+    cached = coll.find_one(cached_result_filter(pdf_hash), {"data": 1})
+    if cached:
+        return cached["data"]
+
+    layouts = load_page_layouts(pdf_bytes, client)
 
     # Prepare JSON structure
+    data = sheet_data(layouts)
+
+    # Store into MongoDB
+    coll.replace_one(
+        {"sha256": pdf_hash},
+        result_document(file_name, pdf_hash, data),
+        upsert=True
+    )
+
+    return data
+
+
+def iter_spreadsheet_rows(pdf_bytes: bytes, file_name: str, client=None):
+    """
+    Generator variant of analyze_spreadsheet_auto_merge: yields SheetRows
+    page by page while later pages are still being analyzed, and stores
+    the complete result in MongoDB once the last row is out.
+    """
+    pdf_hash = hashlib.sha256(pdf_bytes).hexdigest()
+    cached = coll.find_one(cached_result_filter(pdf_hash), {"data": 1})
+    if cached:
+        for row in cached["data"]["sheets"][0]["rows"]:
+            yield SheetRow(row["index"], tuple(c["value"] for c in row["cells"]))
+        return
+
+    rows = []
+    for row in iter_merged_rows(iter_page_layouts(pdf_bytes, client)):
+        rows.append(row)
+        yield row
+
+    data = {"activeSheet": "Sheet1", "sheets": [{"name": "Sheet1", "rows": [row_dict(r) for r in rows]}]}
+    coll.replace_one(
+        {"sha256": pdf_hash},
+        result_document(file_name, pdf_hash, data),
+        upsert=True
+    )
+
+
+def sheet_data(layouts: list) -> dict:
     data = {"activeSheet": "Sheet1", "sheets": [{"name": "Sheet1", "rows": []}]}
-    sheet_rows = []
+    data["sheets"][0]["rows"] = merge_pages(layouts)
+    return data
+
+
+def page_hash(page) -> str:
+    """
+    Fingerprint of one PDF page: its content stream, size, crop box,
+    rotation, fonts and embedded images/forms. The same page inside another
+    PDF (e.g. the same report with a page appended) gets the same hash.
+    """
+    h = hashlib.sha256(f"{LAYOUT_MODEL}:{LAYOUT_CACHE_VERSION}".encode())
+    h.update(repr([float(v) for v in page.mediabox] + [float(v) for v in page.cropbox]
+                  + [page.rotation]).encode())
+    contents = page.get_contents()
+    if isinstance(contents, ArrayObject):
+        # /Contents may be an array of streams, hashed in drawing order
+        for part in contents:
+            h.update(part.get_object().get_data())
+    elif contents is not None:
+        h.update(contents.get_data())
+    resources = page.get("/Resources")
+    resources = resources.get_object() if resources is not None else {}
+    fonts = resources.get("/Font")
+    if fonts is not None:
+        for name, font in sorted(fonts.get_object().items()):
+            h.update(f"{name}={font.get_object().get('/BaseFont')}".encode())
+    xobjects = resources.get("/XObject")
+    if xobjects is not None:
+        for name, xobj in sorted(xobjects.get_object().items()):
+            h.update(name.encode())
+            h.update(xobj.get_object().get_data())
+    return h.hexdigest()
+
+
+def load_page_layouts(pdf_bytes: bytes, client=None) -> list:
+    """Per-page layouts in page order, from the page cache or Azure."""
+    return list(iter_page_layouts(pdf_bytes, client))
+
+
+def iter_page_layouts(pdf_bytes: bytes, client=None):
+    """
+    Per-page layouts in page order, each yielded as soon as it and every
+    page before it are known; analyzed windows go to the page cache as
+    they arrive.
+    """
+    try:
+        reader, hashes = fingerprint_pages(pdf_bytes)
+    except Exception:
+        log.warning("Could not fingerprint PDF pages; analyzing without the page cache", exc_info=True)
+        yield from analyze_layout(io.BytesIO(pdf_bytes), client)
+        return
+
+    layouts = {d["_id"]: d["layout"]
+               for d in page_coll.find({"_id": {"$in": list(set(hashes))}})}
+    todo = pages_to_analyze(hashes, layouts)
+    if todo:
+        log.info("Layout cache: %d of %d pages need analysis", len(todo), len(hashes))
+    windows = iter_analyzed_windows(pdf_bytes, reader, todo, client)
+    try:
+        for h in hashes:
+            while h not in layouts:
+                pages, fresh = next(windows)
+                page_coll.bulk_write(cache_writes(hashes, pages, fresh), ordered=False)
+                layouts.update({hashes[i]: lay for i, lay in zip(pages, fresh)})
+            yield layouts[h]
+    finally:
+        windows.close()
+
+
+def fingerprint_pages(pdf_bytes: bytes):
+    reader = PdfReader(io.BytesIO(pdf_bytes))
+    return reader, [page_hash(p) for p in reader.pages]
+
+
+def pages_to_analyze(hashes: list, cached: dict) -> list:
+    """Indexes of the pages to send to Azure: uncached, each distinct page once."""
+    todo, seen = [], set(cached)
+    for i, h in enumerate(hashes):
+        if h not in seen:
+            seen.add(h)
+            todo.append(i)
+    return todo
+
+
+def cache_writes(hashes: list, todo: list, fresh: list) -> list:
+    return [ReplaceOne({"_id": hashes[i]}, {"_id": hashes[i], "layout": lay}, upsert=True)
+            for i, lay in zip(todo, fresh)]
+
+
+def subset_pdf(reader, page_indexes) -> io.BytesIO:
+    writer = PdfWriter()
+    for i in page_indexes:
+        writer.add_page(reader.pages[i])
+    out = io.BytesIO()
+    writer.write(out)
+    out.seek(0)
+    return out
+
+
+def layout_windows(pdf_bytes: bytes, reader, page_indexes) -> list:
+    """
+    (page indexes, PDF stream) per window of LAYOUT_WINDOW_PAGES pages.
+    All windows are cut up front because PdfReader is not thread-safe.
+    """
+    size = LAYOUT_WINDOW_PAGES or len(page_indexes)
+    windows = [page_indexes[i:i + size] for i in range(0, len(page_indexes), size)]
+    if len(windows) == 1 and len(page_indexes) == len(reader.pages):
+        return [(windows[0], io.BytesIO(pdf_bytes))]
+    return [(w, subset_pdf(reader, w)) for w in windows]
+
+
+def check_window(fresh: list, pages: list) -> list:
+    if len(fresh) != len(pages):
+        raise RuntimeError(f"Azure returned {len(fresh)} pages for {len(pages)} submitted")
+    return fresh
+
+
+def analyze_pages(pdf_bytes: bytes, reader, page_indexes, client=None) -> list:
+    """Layouts of the given pages, in the order given."""
+    return [lay for _, fresh in iter_analyzed_windows(pdf_bytes, reader, page_indexes, client)
+            for lay in fresh]
+
+
+def iter_analyzed_windows(pdf_bytes: bytes, reader, page_indexes, client=None):
+    """
+    (page indexes, layouts) per window of LAYOUT_WINDOW_PAGES, in page
+    order. At most LAYOUT_MAX_IN_FLIGHT windows are analyzed at once, so a
+    long document takes about as long as its slowest few windows rather
+    than one call per whole file. Closing the generator early cancels the
+    windows not started yet.
+    """
+    if not page_indexes:
+        return
+    windows = layout_windows(pdf_bytes, reader, page_indexes)
+
+    def analyze_window(window):
+        pages, stream = window
+        return check_window(analyze_layout(stream, client), pages)
+
+    if len(windows) == 1:
+        yield windows[0][0], analyze_window(windows[0])
+        return
+    log.info("Analyzing %d pages in %d windows", len(page_indexes), len(windows))
+    workers = max(1, min(LAYOUT_MAX_IN_FLIGHT, len(windows)))
+    pool = ThreadPoolExecutor(workers, thread_name_prefix="layout")
+    try:
+        futures = [pool.submit(analyze_window, w) for w in windows]
+        for (pages, _), fut in zip(windows, futures):
+            yield pages, fut.result()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def analyze_layout(stream, client=None) -> list:
+    # Run Form Recognizer; throttles and retries are left to layout_throttle
+    def run():
+        stream.seek(0)
+        poller = (client or doc_client).begin_analyze_document(
+            LAYOUT_MODEL, document=stream, retry_total=0)
+        return poller.result()
+    return page_layouts(layout_throttle.call(run))
+
+
+def _points(polygon):
+    return [[p.x, p.y] for p in polygon]
+
+
+def page_layouts(result) -> list:
+    """
+    Reduce an AnalyzeResult to what the merge needs, one JSON-serialisable
+    dict per page: { lines: [{polygon, text}], tables: [{polygon, cells}] }.
+    A table belongs to the page of its first bounding region.
+    """
+    tables_by_page = {}
+    for tbl in result.tables:
+        region = tbl.bounding_regions[0]
+        tables_by_page.setdefault(region.page_number, []).append({
+            "polygon": _points(region.polygon),
+            "cells": [{"row": c.row_index,
+                       "col": c.column_index,
+                       # detect colspan (default 1)
+                       "span": getattr(c, "column_span", 1),
+                       "text": c.content.strip()}
+                      for c in tbl.cells]
+        })
+    return [{
+        "lines": [{"polygon": _points(line.polygon), "text": line.content.strip()}
+                  for line in page.lines],
+        "tables": tables_by_page.get(page.page_number, [])
+    } for page in result.pages]
+
+
+# One merged row: its 1-based sheet index and the cell texts left to right
+SheetRow = namedtuple("SheetRow", "index values")
+
+
+def row_dict(row: SheetRow) -> dict:
+    """A SheetRow in the analyzer output format."""
+    return {"cells": [{"value": v, "enable": True, "index": i + 1} for i, v in enumerate(row.values)],
+            "index": row.index}
+
+
+def merge_pages(layouts: list) -> list:
+    """Merge per-page layouts into the sheet rows of the analyzer output."""
+    return [row_dict(row) for row in iter_merged_rows(layouts)]
+
+
+def iter_merged_rows(layouts):
+    """
+    SheetRows of the merged sheet, yielded page by page as each layout is
+    merged, so `layouts` may itself be a generator still waiting on Azure.
+    """
     current_row = 1
 
     # Process each page
-    for page in result.pages:
+    for layout in layouts:
         # Collect tables with geometry
         tables = []
-        for tbl in result.tables:
-            region = tbl.bounding_regions[0]
-            if region.page_number != page.page_number:
-                continue
-            coords = [(p.x, p.y) for p in region.polygon]
+        for order, tbl in enumerate(layout["tables"]):
+            coords = [tuple(p) for p in tbl["polygon"]]
             ys = [y for _, y in coords]
             xs = [x for x, _ in coords]
             poly = Polygon(coords)
             tables.append({
-                "table": tbl,
+                "cells": tbl["cells"],
                 "poly": poly,
                 "ymin": min(ys),
                 "ymax": max(ys),
-                "xmin": min(xs)
+                "xmin": min(xs),
+                "order": order
             })
-        # Cluster into bands
+        # Cluster into bands: sweep tables by top edge, merging every table
+        # whose vertical extent touches the band built so far
         bands = []
-        for tbl in tables:
-            placed = False
-            for band in bands:
-                if not (tbl["ymax"] < band["ymin"] or tbl["ymin"] > band["ymax"]):
-                    band["tables"].append(tbl)
-                    band["ymin"] = min(band["ymin"], tbl["ymin"])
-                    band["ymax"] = max(band["ymax"], tbl["ymax"])
-                    placed = True
-                    break
-            if not placed:
+        for tbl in sorted(tables, key=lambda t: t["ymin"]):
+            if bands and tbl["ymin"] <= bands[-1]["ymax"]:
+                band = bands[-1]
+                band["tables"].append(tbl)
+                band["ymax"] = max(band["ymax"], tbl["ymax"])
+            else:
                 bands.append({"tables": [tbl], "ymin": tbl["ymin"], "ymax": tbl["ymax"]})
 
         # Build layout elements
         elements = []
         for band in bands:
-            # sort left-to-right
-            band["tables"].sort(key=lambda t: t["xmin"])
+            # sort left-to-right (ties keep the analyzer's table order)
+            band["tables"].sort(key=lambda t: (t["xmin"], t["order"]))
             # compute col offsets
             offsets, cum = [], 0
             for t in band["tables"]:
-                ncols = max(c.column_index for c in t["table"].cells) + 1
+                ncols = max(c["col"] for c in t["cells"]) + 1
                 offsets.append(cum)
                 cum += ncols
-                        # collect band rows (handle colspan)
+            # collect band rows (handle colspan)
             band_rows = {}
             for idx, t in enumerate(band["tables"]):
                 off = offsets[idx]
-                for cell in t["table"].cells:
-                    r, c = cell.row_index, cell.column_index
-                    # detect colspan (default 1)
-                    span = getattr(cell, 'column_span', 1)
-                    for span_idx in range(span):
+                for cell in t["cells"]:
+                    r, c = cell["row"], cell["col"]
+                    for span_idx in range(cell["span"]):
                         col_key = off + c + span_idx
                         band_rows.setdefault(r, []).append({
                             "col": col_key,
-                            "text": cell.content.strip()
+                            "text": cell["text"]
                         })
             elements.append({"type": "band", "y": band["ymin"], "rows": band_rows})
 
-        # Add non-table text
-        table_polys = [b["poly"] for b in tables]
-        for line in page.lines:
-            coords = [(p.x, p.y) for p in line.polygon]
-            ys = [y for _, y in coords]
-            cy = sum(ys) / len(ys)
-            pt = Point(sum(x for x, _ in coords) / len(coords), cy)
-            if not any(poly.contains(pt) for poly in table_polys):
-                elements.append({"type": "line", "y": cy, "text": line.content.strip()})
+        # Add non-table text: one spatial query for all line centres
+        centres = []
+        for line in layout["lines"]:
+            coords = line["polygon"]
+            centres.append((sum(x for x, _ in coords) / len(coords),
+                            sum(y for _, y in coords) / len(coords)))
+        in_table = set()
+        if tables and centres:
+            tree = STRtree([t["poly"] for t in tables])
+            hits = tree.query([Point(x, y) for x, y in centres], predicate="within")
+            in_table = set(hits[0].tolist())
+        for i, line in enumerate(layout["lines"]):
+            if i not in in_table:
+                elements.append({"type": "line", "y": centres[i][1], "text": line["text"]})
 
         # Sort and emit
         elements.sort(key=lambda e: e["y"])
@@ -117,21 +411,9 @@ def analyze_spreadsheet_auto_merge(pdf_bytes: bytes, file_name: str) -> dict:
                 for r in sorted(el["rows"]):
                     cells = el["rows"][r]
                     cells.sort(key=lambda x: x["col"])
-                    row_cells = [{"value": c["text"], "enable": True, "index": i + 1}
-                                 for i, c in enumerate(cells)]
-                    sheet_rows.append({"cells": row_cells, "index": current_row})
+                    yield SheetRow(current_row, tuple(c["text"] for c in cells))
                     current_row += 1
                 current_row += 1
             else:
-                sheet_rows.append({
-                    "cells": [{"value": el["text"], "enable": True, "index": 1}],
-                    "index": current_row
-                })
+                yield SheetRow(current_row, (el["text"],))
                 current_row += 1
-
-    data["sheets"][0]["rows"] = sheet_rows
-
-    # Store into MongoDB
-    coll.insert_one({"filename": file_name, "merged": True, "data": data})
-
-    return data
\ No newline at end of file
@@ -0,0 +1,106 @@
+import re
+import sys
+import math
+import heapq
+from array import array
+from collections import Counter
+
+TOKEN_PAT = re.compile(r"\w{2,}")
+BM25_K1 = 1.2
+BM25_B  = 0.75
+SNIPPET_CHARS = 160
+
+
+def tokenize(text):
+    return TOKEN_PAT.findall(text.lower())
+
+
+def _pack(values):
+    # little-endian uint32 on disk whatever the host
+    arr = array("I", values)
+    if sys.byteorder == "big":
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def _unpack(data):
+    arr = array("I")
+    arr.frombytes(data)
+    if sys.byteorder == "big":
+        arr.byteswap()
+    return arr
+
+
+def build_search_index(page_texts):
+    """
+    Inverted index over page text for BM25. Returns (stats, postings):
+    stats = { page_lens, avg_len } for the mapping document, postings =
+    { term: (pages, tfs) } with 1-based pages ascending and packed as
+    uint32 arrays, one document per term in the postings collection.
+    """
+    page_lens = []
+    postings = {}
+    for page_no, text in enumerate(page_texts, start=1):
+        terms = tokenize(text)
+        page_lens.append(len(terms))
+        for term, tf in Counter(terms).items():
+            pages, tfs = postings.setdefault(term, ([], []))
+            pages.append(page_no)
+            tfs.append(tf)
+    stats = {
+        "page_lens": _pack(page_lens),
+        "avg_len": (sum(page_lens) / len(page_lens)) if page_lens else 0.0,
+    }
+    return stats, {t: (_pack(p), _pack(f)) for t, (p, f) in postings.items()}
+
+
+def ensure_search_indexes(postings_coll):
+    postings_coll.create_index([("mapping_id", 1), ("term", 1)], unique=True)
+
+
+def posting_documents(mapping_id, postings):
+    return [{"mapping_id": mapping_id, "term": term, "pages": pages, "tfs": tfs}
+            for term, (pages, tfs) in postings.items()]
+
+
+def store_search_index(postings_coll, mapping_id, postings):
+    if not postings:
+        return
+    postings_coll.insert_many(posting_documents(mapping_id, postings), ordered=False)
+
+
+def delete_search_index(postings_coll, mapping_id):
+    postings_coll.delete_many({"mapping_id": mapping_id})
+
+
+def bm25_search(postings_coll, mapping_id, stats, query, k=5):
+    """Top-k (page, score) for the query, best first."""
+    terms = sorted(set(tokenize(query)))
+    if not terms or not stats:
+        return []
+    page_lens = _unpack(stats["page_lens"])
+    n_pages = len(page_lens)
+    avg_len = stats["avg_len"] or 1.0
+
+    scores = {}
+    for doc in postings_coll.find({"mapping_id": mapping_id, "term": {"$in": terms}}):
+        pages, tfs = _unpack(doc["pages"]), _unpack(doc["tfs"])
+        df = len(pages)
+        idf = math.log(1 + (n_pages - df + 0.5) / (df + 0.5))
+        for page, tf in zip(pages, tfs):
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * page_lens[page - 1] / avg_len)
+            scores[page] = scores.get(page, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+    return heapq.nlargest(k, scores.items(), key=lambda ps: ps[1])
+
+
+def make_snippet(text, query, width=SNIPPET_CHARS):
+    """A window of the page text around the first query term it contains."""
+    text = re.sub(r"\s+", " ", text).strip()
+    terms = set(tokenize(query))
+    m = None
+    if terms:
+        pat = r"\b(?:" + "|".join(re.escape(t) for t in sorted(terms, key=len, reverse=True)) + r")\b"
+        m = re.search(pat, text, re.IGNORECASE)
+    start = max(0, (m.start() if m else 0) - width // 2)
+    snippet = text[start:start + width]
+    return ("…" if start > 0 else "") + snippet + ("…" if start + width < len(text) else "")
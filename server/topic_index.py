@@ -0,0 +1,18 @@
+# topic_index.py
+"""
+Topic and section index builders for the upload path. The action server
+reads these structures, so the one implementation lives with it in
+rasa_backend/actions/topic_index.py and is re-exported here.
+"""
+import rasa_shared  # noqa: F401
+from actions.topic_index import (
+    SECTION_INDEX_VERSION,
+    SECTION_PAT,
+    TOPIC_INDEX_VERSION,
+    build_section_index,
+    build_topic_index,
+    clean_topic_key,
+    normalize_topic,
+    section_depths,
+    trigrams,
+)